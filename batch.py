@@ -0,0 +1,94 @@
+import os
+import sys
+import logging
+import argparse
+import threading
+from config import load_config
+from executor import map_ordered
+from main import setup, run_analysis
+
+# Include the analyzed system in every log line
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(levelname)s - %(threadName)s - %(message)s",
+    handlers=[logging.StreamHandler()],
+    force=True,
+)
+
+
+# Collect the system config files from the given files and directories
+def find_system_configs(paths: list) -> list:
+    configs = []
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.endswith((".yml", ".yaml")):
+                    configs.append(os.path.join(path, name))
+        else:
+            configs.append(path)
+
+    names = [os.path.splitext(os.path.basename(path))[0] for path in configs]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f"System config names must be unique, got {duplicates}")
+    return configs
+
+
+# Analyze every system concurrently without user interaction. All systems share
+# one chatbot, so they share its rate limit and caches, and each system writes
+# its results to its own directory under output_dir.
+def run_batch(paths: list, base_path="config.yml", output_dir="runs", parallel=4):
+    base = load_config(base_path)
+    chatbot = setup(base)
+    configs = find_system_configs(paths)
+    logging.info(f"Analyzing {len(configs)} systems, {parallel} at a time")
+
+    def run(path):
+        name = os.path.splitext(os.path.basename(path))[0]
+        threading.current_thread().name = name
+        try:
+            config = load_config(path, base=base)
+            run_analysis(
+                config,
+                chatbot,
+                output_dir=os.path.join(output_dir, name),
+                interactive=False,
+            )
+        except Exception:
+            logging.exception(f"Analysis of {name} failed")
+            return name
+        logging.info(f"Analysis of {name} finished")
+        return None
+
+    failures = [name for name in map_ordered(run, configs, workers=parallel) if name]
+    logging.info(f"{len(configs) - len(failures)} of {len(configs)} analyses finished")
+    if failures:
+        logging.error(f"Failed analyses: {failures}")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Analyze many ML systems in one unattended run."
+    )
+    parser.add_argument(
+        "systems",
+        nargs="+",
+        help="System config files, or directories containing them. Sections "
+        "missing from a system config are taken from the base config.",
+    )
+    parser.add_argument("--base", default="config.yml", help="Base config file.")
+    parser.add_argument(
+        "--output-dir", default="runs", help="Directory for per-system results."
+    )
+    parser.add_argument(
+        "--parallel", type=int, default=4, help="Systems analyzed at the same time."
+    )
+    args = parser.parse_args()
+    failures = run_batch(args.systems, args.base, args.output_dir, args.parallel)
+    sys.exit(1 if failures else 0)
+
+
+# Entry point for the script
+if __name__ == "__main__":
+    main()
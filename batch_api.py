@@ -0,0 +1,295 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import hashlib
+import logging
+from openai.types.chat import ChatCompletion
+from OpenAIChatHelper import ChatCompletionEndPoint
+from OpenAIChatHelper.message import MessageList, AssistantMessage, TextContent
+from completion_cache import CachedChatCompletionEndPoint
+from executor import map_ordered
+import telemetry
+
+# Fan-out steps sent through the batch endpoint unless configured otherwise
+BATCH_STEPS = [
+    "identify_values",
+    "identify_losses",
+    "identify_losses_batched",
+    "identify_hazards",
+    "merge_hazard_clusters",
+]
+
+# Batch states after which no results will arrive
+FAILED_STATUSES = ["failed", "expired", "cancelled"]
+
+
+class OpenAIBatchProvider:
+    """
+    Submits request files to the OpenAI Batch API and fetches their results.
+    The client is created on first use.
+    """
+
+    def __init__(self, completion_window="24h"):
+        self.completion_window = completion_window
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            from openai import OpenAI
+
+            self._client = OpenAI()
+        return self._client
+
+    # Upload a JSONL request file and start a batch, returning its id
+    def submit(self, input_path) -> str:
+        with open(input_path, "rb") as file:
+            uploaded = self.client.files.create(file=file, purpose="batch")
+        batch = self.client.batches.create(
+            input_file_id=uploaded.id,
+            endpoint="/v1/chat/completions",
+            completion_window=self.completion_window,
+        )
+        return batch.id
+
+    # Status of a batch, and the JSONL result lines once it completed
+    def poll(self, batch_id):
+        batch = self.client.batches.retrieve(batch_id)
+        if batch.status != "completed":
+            return batch.status, None
+        lines = []
+        for file_id in [batch.output_file_id, batch.error_file_id]:
+            if file_id:
+                lines.extend(self.client.files.content(file_id).text.splitlines())
+        return batch.status, lines
+
+
+class LocalBatchProvider:
+    """
+    File-based stand-in for the Batch API. A submitted batch is a directory
+    holding input.jsonl, and it completes once output.jsonl appears next to
+    it, in the result format of the Batch API. With a respond function, which
+    answers one request body with a chat completion body, the provider writes
+    the output itself on the first poll. Otherwise another process must.
+    """
+
+    def __init__(self, path=".cache/batches/local", respond=None):
+        self.path = path
+        self.respond = respond
+        os.makedirs(path, exist_ok=True)
+
+    def submit(self, input_path) -> str:
+        batch_id = f"batch_{uuid.uuid4().hex}"
+        os.makedirs(os.path.join(self.path, batch_id))
+        shutil.copyfile(input_path, os.path.join(self.path, batch_id, "input.jsonl"))
+        return batch_id
+
+    def poll(self, batch_id):
+        output_path = os.path.join(self.path, batch_id, "output.jsonl")
+        if not os.path.exists(output_path):
+            if self.respond is None:
+                return "in_progress", None
+            self.process(batch_id)
+        with open(output_path, "r") as file:
+            return "completed", file.read().splitlines()
+
+    # Answer every request of a batch concurrently and write its output file
+    def process(self, batch_id):
+        with open(os.path.join(self.path, batch_id, "input.jsonl"), "r") as file:
+            requests = [json.loads(line) for line in file]
+
+        def answer(request):
+            result = {"custom_id": request["custom_id"], "error": None}
+            try:
+                body = self.respond(request["body"])
+                result["response"] = {"status_code": 200, "body": body}
+            except Exception as e:
+                result["response"] = None
+                result["error"] = {"message": str(e)}
+            return json.dumps(result)
+
+        lines = map_ordered(answer, requests)
+        output_path = os.path.join(self.path, batch_id, "output.jsonl")
+        with open(f"{output_path}.tmp", "w") as file:
+            file.write("\n".join(lines) + "\n")
+        os.replace(f"{output_path}.tmp", output_path)
+
+
+# Batch providers selectable in config.yml
+PROVIDERS = {
+    "openai": OpenAIBatchProvider,
+    "local": LocalBatchProvider,
+}
+
+
+class BatchRunner:
+    """
+    Runs the requests of a fan-out as provider batches instead of one
+    synchronous call each. Every batch file is named by the hash of its
+    content and the id of its submitted batch is kept next to it, so a
+    restarted run polls the batches it already submitted instead of paying
+    for them again. Requests that fail inside a batch are sent synchronously.
+    """
+
+    def __init__(
+        self,
+        provider,
+        steps=None,
+        path=".cache/batches",
+        poll_interval=30,
+        max_requests=50000,
+    ):
+        self.provider = provider
+        self.steps = BATCH_STEPS if steps is None else steps
+        self.path = path
+        self.poll_interval = poll_interval
+        self.max_requests = max_requests
+        os.makedirs(path, exist_ok=True)
+
+    # Submit the rendered requests of the contexts and wait for the responses,
+    # returned as (res, meta) pairs in input order. Responses in the completion
+    # cache of the chatbot are not submitted, and the others are cached once
+    # they arrive. Every request is recorded in the telemetry of the step, with
+    # the time until its batch completed as its latency.
+    def run(
+        self,
+        step: str,
+        chatbot: ChatCompletionEndPoint,
+        message_list: MessageList,
+        contexts: list,
+        params: dict,
+        labels: list = None,
+    ) -> list:
+        labels = labels or [None] * len(contexts)
+        cache = chatbot if isinstance(chatbot, CachedChatCompletionEndPoint) else None
+        responses = [None] * len(contexts)
+        if cache is not None:
+            for i, context in enumerate(contexts):
+                responses[i] = cache.lookup(message_list, context, **params)
+                if responses[i] is not None:
+                    telemetry.record_request(
+                        step, labels[i], 0.0, responses[i], cached=True
+                    )
+        uncached = [i for i, response in enumerate(responses) if response is None]
+        if not uncached:
+            return responses
+        telemetry.expect_requests(step, len(uncached))
+
+        model = params.get("model") or chatbot._default_model
+        requests = [
+            {
+                "custom_id": f"{step}-{i}",
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    **params,
+                    "model": model,
+                    "messages": message_list.to_dict(contexts[i]),
+                },
+            }
+            for i in uncached
+        ]
+
+        start = time.perf_counter()
+        pending = {}
+        for first in range(0, len(requests), self.max_requests):
+            batch_id, state_path = self.submit(
+                requests[first : first + self.max_requests]
+            )
+            pending[batch_id] = state_path
+        logging.info(
+            f"Waiting for {len(requests)} {step} requests in {len(pending)} batches"
+        )
+
+        while True:
+            for batch_id in list(pending):
+                status, lines = self.provider.poll(batch_id)
+                if status in FAILED_STATUSES:
+                    # Forget the batch so that a rerun submits it again
+                    os.remove(pending[batch_id])
+                    raise RuntimeError(f"Batch {batch_id} of {step} {status}")
+                if lines is None:
+                    continue
+                for line in lines:
+                    result = json.loads(line)
+                    response = result.get("response") or {}
+                    if (
+                        result.get("error") is None
+                        and response.get("status_code") == 200
+                    ):
+                        i = int(result["custom_id"].rsplit("-", 1)[1])
+                        responses[i] = load_response(response["body"])
+                        telemetry.record_request(
+                            step, labels[i], time.perf_counter() - start, responses[i]
+                        )
+                        if cache is not None:
+                            cache.store(
+                                responses[i], message_list, contexts[i], **params
+                            )
+                del pending[batch_id]
+            if not pending:
+                break
+            logging.info(f"{len(pending)} batches of {step} still running")
+            time.sleep(self.poll_interval)
+
+        # Requests that failed inside their batch are retried one by one
+        failed = [i for i in uncached if responses[i] is None]
+        if failed:
+            logging.warning(
+                f"{len(failed)} {step} requests failed in their batch, sending them directly"
+            )
+        for i in failed:
+            with telemetry.track_request(step, labels[i]) as request:
+                request["response"] = chatbot.completions(
+                    message_list, substitution_dict=contexts[i], **params
+                )
+                responses[i] = request["response"]
+        return responses
+
+    # Write a request file and submit it, unless the same file was submitted
+    # before. Returns the batch id and the path of the file recording it.
+    def submit(self, requests: list):
+        content = "".join(
+            json.dumps(request, sort_keys=True) + "\n" for request in requests
+        )
+        digest = hashlib.sha256(content.encode("utf-8")).hexdigest()
+        state_path = os.path.join(self.path, f"{digest}.json")
+        if os.path.exists(state_path):
+            with open(state_path, "r") as file:
+                batch_id = json.load(file)["batch_id"]
+            logging.info(f"Resuming batch {batch_id}")
+            return batch_id, state_path
+
+        input_path = os.path.join(self.path, f"{digest}.jsonl")
+        with open(input_path, "w") as file:
+            file.write(content)
+        batch_id = self.provider.submit(input_path)
+        with open(state_path, "w") as file:
+            json.dump({"batch_id": batch_id, "requests": len(requests)}, file)
+        logging.info(f"Submitted batch {batch_id} with {len(requests)} requests")
+        return batch_id, state_path
+
+
+# Create the batch runner configured in config.yml
+def make_batch_runner(provider="openai", path=".cache/batches", **options):
+    if provider not in PROVIDERS:
+        raise ValueError(
+            f"Invalid batch provider: {provider}. Must be one of {list(PROVIDERS)}"
+        )
+    if provider == "local":
+        provider = LocalBatchProvider(os.path.join(path, "local"))
+    else:
+        provider = PROVIDERS[provider]()
+    return BatchRunner(provider, path=path, **options)
+
+
+# Rebuild the (res, meta) pair of ChatCompletionEndPoint.completions from a
+# chat completion response body
+def load_response(body: dict):
+    res = [
+        AssistantMessage(TextContent(choice["message"]["content"] or ""))
+        for choice in body["choices"]
+    ]
+    return res, ChatCompletion.model_validate(body)
@@ -0,0 +1,337 @@
+import os
+import json
+import time
+import logging
+import argparse
+import tempfile
+from batch_api import BatchRunner, LocalBatchProvider
+from config import load_config, STEP_RESULTS
+from executor import set_batch_runner
+from mock import MockChatCompletionEndPoint, MockEmbeddingBackend
+from main import setup, run_analysis
+from utils import load_records
+import embedding
+import telemetry
+
+# Named scales as (stakeholders, values per stakeholder, hazards per loss)
+SCALES = {
+    "small": (4, 3, 3),
+    "medium": (8, 5, 5),
+    "large": (16, 8, 8),
+}
+
+# Columns of the report table, as (key, header)
+COLUMNS = [
+    ("step", "step"),
+    ("wall_time", "wall s"),
+    ("requests", "requests"),
+    ("cached_requests", "cached"),
+    ("retries", "retries"),
+    ("parse_failures", "parse fail"),
+    ("prompt_tokens", "prompt tok"),
+    ("completion_tokens", "compl tok"),
+    ("embedded_texts", "embedded"),
+    ("items", "items"),
+]
+
+
+# Parse a scale name or "StakeholdersxValuesxHazards", such as 8x5x5
+def parse_scale(scale: str) -> tuple:
+    if scale in SCALES:
+        return SCALES[scale]
+    try:
+        n_stakeholders, n_values, n_hazards = (int(n) for n in scale.split("x"))
+    except ValueError:
+        raise ValueError(
+            f"Invalid scale: {scale}. Must be one of {list(SCALES)} or SxVxH"
+        )
+    return n_stakeholders, n_values, n_hazards
+
+
+# Number of items in the result of a step
+def count_items(result) -> int:
+    if not result or not isinstance(result[0], dict):
+        return len(result)
+    item = result[0]
+    if "hazards" in item:
+        return sum(len(h) for i in result for h in i["hazards"].values())
+    if "losses" in item:
+        return sum(len(i["losses"]) for i in result)
+    if "values" in item:
+        return sum(len(i["values"]) for i in result)
+    return len(result)
+
+
+# Rows of the report table from the telemetry of a pass, with the number of
+# items in the saved result of every step
+def step_rows(recorder, output_dir) -> list:
+    rows = []
+    for step, stats in recorder.report()["steps"].items():
+        row = {
+            "step": step,
+            "wall_time": stats["wall_time"],
+            "embedded_texts": stats["embeddings"]["embedded"],
+        }
+        for key, header in COLUMNS[2:]:
+            if key in stats:
+                row[key] = stats[key]
+        if step in STEP_RESULTS:
+            base_path = os.path.join(output_dir, STEP_RESULTS[step])
+            try:
+                row["items"] = count_items(list(load_records(base_path)))
+            except FileNotFoundError:
+                pass
+        rows.append(row)
+    return rows
+
+
+# Benchmark the analysis at one scale, running main.run_analysis against the
+# mock servers and reporting the telemetry of its steps. Caches start empty in
+# a temporary directory, and with warm a second pass measures the run with
+# filled caches.
+# With batch_api, the batched steps go through a local batch provider
+# answered by the mock server. malformed_rate of the answers cannot be
+# parsed. Returns one report per pass.
+def run_benchmark(
+    config: dict,
+    scale: str,
+    latency=0.2,
+    jitter=0.1,
+    embedding_latency=0.05,
+    rate_limit_rate=0.0,
+    seed=0,
+    warm=False,
+    batch_api=False,
+    malformed_rate=0.0,
+) -> list:
+    n_stakeholders, n_values, n_hazards = parse_scale(scale)
+    reports = []
+    with tempfile.TemporaryDirectory() as cache_dir:
+        config = dict(config)
+        config["checkpoint"] = None
+        config["skip_steps"] = []
+        config["embedding"] = None
+        config["batch_api"] = None
+        config["task_queue"] = None
+        config["telemetry"] = {
+            **(config.get("telemetry") or {}),
+            "progress_interval": None,
+        }
+        if config.get("embedding_cache") is not None:
+            config["embedding_cache"] = {
+                **config["embedding_cache"],
+                "path": os.path.join(cache_dir, "embeddings"),
+            }
+        if config.get("completion_cache") is not None:
+            config["completion_cache"] = {
+                **config["completion_cache"],
+                "path": os.path.join(cache_dir, "completions.sqlite"),
+            }
+        if config.get("hazard_index") is not None:
+            config["hazard_index"] = {
+                **config["hazard_index"],
+                "path": os.path.join(cache_dir, "hazard_index"),
+            }
+
+        for pass_name in ["cold", "warm"] if warm else ["cold"]:
+            mock_chatbot = MockChatCompletionEndPoint(
+                default_model=config["chatbot"]["model"],
+                n_stakeholders=n_stakeholders,
+                n_values=n_values,
+                n_hazards=n_hazards,
+                latency=latency,
+                jitter=jitter,
+                rate_limit_rate=rate_limit_rate,
+                malformed_rate=malformed_rate,
+                seed=seed,
+            )
+            embedder = MockEmbeddingBackend(
+                latency=embedding_latency, jitter=embedding_latency / 2, seed=seed
+            )
+            embedding.set_backend(embedder)
+            chatbot = setup(config, chatbot=mock_chatbot)
+            if batch_api and not (config.get("pipeline") or {}).get("streaming"):
+                provider = LocalBatchProvider(
+                    os.path.join(cache_dir, "batches", "local"),
+                    respond=mock_chatbot.respond,
+                )
+                set_batch_runner(
+                    BatchRunner(
+                        provider,
+                        path=os.path.join(cache_dir, "batches"),
+                        poll_interval=0.1,
+                    )
+                )
+            # Every pass writes its results and journal to a new directory
+            output_dir = os.path.join(cache_dir, pass_name)
+
+            error = None
+            start = time.perf_counter()
+            try:
+                run_analysis(config, chatbot, output_dir, interactive=False)
+            except Exception as e:
+                logging.exception(f"Benchmark {scale} ({pass_name}) failed")
+                error = repr(e)
+            finally:
+                set_batch_runner(None)
+            reports.append(
+                {
+                    "scale": scale,
+                    "pass": pass_name,
+                    "wall_time": time.perf_counter() - start,
+                    "error": error,
+                    "steps": step_rows(telemetry.recorder(), output_dir),
+                    "server": {
+                        "requests": mock_chatbot.server.requests,
+                        "rate_limited": mock_chatbot.server.rate_limited,
+                        "embedding_requests": embedder.server.requests,
+                    },
+                }
+            )
+    return reports
+
+
+# Format one cell of the report table
+def format_cell(key, value) -> str:
+    if key == "step":
+        return f"{value:<22}"
+    if isinstance(value, float):
+        return f"{value:>10.2f}"
+    return f"{value:>10}"
+
+
+# Print a report as a table with one row per step and a total row
+def print_report(report: dict):
+    print(f"\nScale {report['scale']} ({report['pass']}):")
+    print(
+        " ".join(
+            format_cell("step" if key == "step" else None, header)
+            for key, header in COLUMNS
+        )
+    )
+    total = {"step": "total", "wall_time": report["wall_time"]}
+    for step in report["steps"]:
+        for key, header in COLUMNS[2:]:
+            total[key] = total.get(key, 0) + step.get(key, 0)
+    for row in report["steps"] + [total]:
+        print(" ".join(format_cell(key, row.get(key, 0)) for key, header in COLUMNS))
+    server = report["server"]
+    print(
+        f"Mock servers: {server['requests']} completion requests, "
+        f"{server['rate_limited']} rate limited, "
+        f"{server['embedding_requests']} embedding requests"
+    )
+    if report["error"]:
+        print(f"Failed: {report['error']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the analysis against local mock API servers."
+    )
+    parser.add_argument(
+        "--scale",
+        nargs="+",
+        default=["small", "medium"],
+        help=f"Scales to run, {list(SCALES)} or StakeholdersxValuesxHazards.",
+    )
+    parser.add_argument("--config", default="config.yml", help="Config file.")
+    parser.add_argument(
+        "--latency", type=float, default=0.2, help="Mean completion latency (s)."
+    )
+    parser.add_argument(
+        "--jitter", type=float, default=0.1, help="Completion latency jitter (s)."
+    )
+    parser.add_argument(
+        "--embedding-latency",
+        type=float,
+        default=0.05,
+        help="Mean embedding request latency (s).",
+    )
+    parser.add_argument(
+        "--rate-limit-rate",
+        type=float,
+        default=0.0,
+        help="Fraction of completion requests rejected with a 429.",
+    )
+    parser.add_argument(
+        "--malformed-rate",
+        type=float,
+        default=0.0,
+        help="Fraction of completion answers that cannot be parsed.",
+    )
+    parser.add_argument(
+        "--structured",
+        choices=["json_schema", "json_object"],
+        help="Ask for JSON responses in this structured output mode.",
+    )
+    parser.add_argument(
+        "--no-rate-limit",
+        action="store_true",
+        help="Do not apply the client-side rate budgets of the config.",
+    )
+    parser.add_argument(
+        "--warm", action="store_true", help="Repeat every scale with warm caches."
+    )
+    parser.add_argument(
+        "--batch-api",
+        action="store_true",
+        help="Send the batched steps through a local batch provider.",
+    )
+    parser.add_argument(
+        "--online-consolidation",
+        action="store_true",
+        help="Consolidate hazards while they are identified.",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Mock server seed.")
+    parser.add_argument("--output", help="Write the reports to this JSON file.")
+    parser.add_argument(
+        "--verbose", action="store_true", help="Log the analysis steps."
+    )
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.WARNING)
+    config = load_config(args.config)
+    if args.no_rate_limit:
+        # Keep the retries and adaptive concurrency, drop the budgets
+        for section in ["rate_limit", "embedding_rate_limit"]:
+            if config.get(section) is not None:
+                config[section] = {
+                    **config[section],
+                    "requests_per_minute": None,
+                    "tokens_per_minute": None,
+                }
+
+    if args.online_consolidation and config.get("online_consolidation") is None:
+        config["online_consolidation"] = {}
+    if args.structured:
+        config["structured_output"] = {
+            **(config.get("structured_output") or {}),
+            "mode": args.structured,
+        }
+
+    reports = []
+    for scale in args.scale:
+        for report in run_benchmark(
+            config,
+            scale,
+            latency=args.latency,
+            jitter=args.jitter,
+            embedding_latency=args.embedding_latency,
+            rate_limit_rate=args.rate_limit_rate,
+            seed=args.seed,
+            warm=args.warm,
+            batch_api=args.batch_api,
+            malformed_rate=args.malformed_rate,
+        ):
+            print_report(report)
+            reports.append(report)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(reports, file, indent=4)
+
+
+# Entry point for the script
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+import os
+import json
+import time
+import logging
+import argparse
+from config import load_config, steps_before, STEP_ORDER, STEP_RESULTS
+from utils import find_records, load_records
+
+# Configure logging like main.py, which is only imported to run steps
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(levelname)s - %(message)s",
+    handlers=[logging.StreamHandler()],
+)
+
+# Steps the streaming pipeline runs together, writing their results while it runs
+STREAMED_STEPS = ["identify_values", "identify_losses", "identify_hazards"]
+
+
+# The file of a step result in output_dir, or None if the step has not run
+def result_path(output_dir, step):
+    try:
+        return find_records(os.path.join(output_dir, STEP_RESULTS[step]))
+    except FileNotFoundError:
+        return None
+
+
+# The first step whose result is missing, or None when the analysis finished.
+# The streaming pipeline writes its results while it runs, so they are only
+# known to be complete once the hazards were consolidated.
+def resume_step(config, output_dir):
+    for step in STEP_ORDER:
+        if result_path(output_dir, step) is None:
+            streaming = (config.get("pipeline") or {}).get("streaming")
+            if streaming and step in STREAMED_STEPS + ["consolidate_hazards"]:
+                return STREAMED_STEPS[0]
+            return step
+    return None
+
+
+# Saved result and journaled units of every step, and the step to resume at
+def analysis_status(config, output_dir) -> dict:
+    units = {}
+    if config.get("journal") is not None:
+        journal_path = os.path.join(output_dir, config["journal"]["path"])
+        if os.path.exists(journal_path):
+            with open(journal_path, "r") as file:
+                for line in file:
+                    try:
+                        step = json.loads(line)["step"]
+                    except (json.JSONDecodeError, KeyError):
+                        continue
+                    units[step] = units.get(step, 0) + 1
+
+    steps = []
+    for step in STEP_ORDER:
+        path = result_path(output_dir, step)
+        records = None
+        if path is not None:
+            base_path = os.path.join(output_dir, STEP_RESULTS[step])
+            records = sum(1 for _ in load_records(base_path))
+        steps.append(
+            {
+                "step": step,
+                "file": os.path.basename(path) if path else None,
+                "records": records,
+                "modified": os.path.getmtime(path) if path else None,
+            }
+        )
+    return {
+        "output_dir": output_dir,
+        "steps": steps,
+        "journal_units": units,
+        "resume_step": resume_step(config, output_dir),
+    }
+
+
+def print_status(status):
+    print(f"Output directory: {status['output_dir']}")
+    for row in status["steps"]:
+        if row["file"] is None:
+            print(f"  {row['step']:<22} missing")
+            continue
+        modified = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(row["modified"]))
+        print(
+            f"  {row['step']:<22} {row['file']:<30} {row['records']:>6} records  {modified}"
+        )
+    if status["journal_units"]:
+        units = ", ".join(f"{k}: {v}" for k, v in status["journal_units"].items())
+        print(f"Journal units: {units}")
+    print(f"Resume at: {status['resume_step'] or 'finished'}")
+
+
+# Run the analysis of the config file at config_path from checkpoint through
+# last_step. The analysis modules are imported here, so that status and help
+# do not pay for their imports.
+def run(
+    config,
+    config_path,
+    output_dir,
+    checkpoint=None,
+    last_step=None,
+    interactive=False,
+):
+    if checkpoint is not None:
+        config["checkpoint"] = checkpoint
+        config["skip_steps"] = steps_before(checkpoint)
+        logging.info(f"Skipping steps: {config['skip_steps']}")
+    import main as analysis
+
+    analysis.run(
+        config,
+        output_dir,
+        interactive=interactive,
+        last_step=last_step,
+        config_path=config_path,
+    )
+
+
+def main():
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--config", default="config.yml", help="Config file.")
+    common.add_argument(
+        "--output-dir", default=".", help="Directory of the step results."
+    )
+
+    parser = argparse.ArgumentParser(
+        description="Run the hazard analysis, or one of its steps."
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser(
+        "run", parents=[common], help="Run the analysis from the config checkpoint."
+    )
+    run_parser.add_argument(
+        "--from",
+        dest="first_step",
+        choices=STEP_ORDER,
+        help="First step to run, loading the results of earlier steps.",
+    )
+    run_parser.add_argument(
+        "--to", dest="last_step", choices=STEP_ORDER, help="Last step to run."
+    )
+    run_parser.add_argument(
+        "--interactive", action="store_true", help="Pause after every step."
+    )
+    commands.add_parser(
+        "resume",
+        parents=[common],
+        help="Continue an interrupted analysis at its first unfinished step.",
+    )
+    status_parser = commands.add_parser(
+        "status", parents=[common], help="Show the progress of an analysis."
+    )
+    status_parser.add_argument("--json", action="store_true", help="Print JSON.")
+    for step in STEP_ORDER:
+        commands.add_parser(
+            step,
+            aliases=[step.replace("_", "-")],
+            parents=[common],
+            help=f"Run only {step}, loading the results of earlier steps.",
+        )
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    if args.command == "status":
+        status = analysis_status(config, args.output_dir)
+        if args.json:
+            print(json.dumps(status, indent=4))
+        else:
+            print_status(status)
+    elif args.command == "run":
+        run(
+            config,
+            args.config,
+            args.output_dir,
+            checkpoint=args.first_step,
+            last_step=args.last_step,
+            interactive=args.interactive,
+        )
+    elif args.command == "resume":
+        step = resume_step(config, args.output_dir)
+        if step is None:
+            logging.info("The analysis already finished")
+            return
+        logging.info(f"Resuming the analysis at {step}")
+        run(config, args.config, args.output_dir, checkpoint=step)
+    else:
+        step = args.command.replace("-", "_")
+        run(config, args.config, args.output_dir, checkpoint=step, last_step=step)
+
+
+# Entry point for the script
+if __name__ == "__main__":
+    main()
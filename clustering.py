@@ -0,0 +1,93 @@
+import math
+import numpy as np
+
+# Clustering methods selectable in config.yml
+METHODS = ["kmeans", "minibatch", "spherical"]
+
+# Lists at least this long are clustered in two levels by the scalable methods
+LARGE_LIST_SIZE = 2048
+
+
+# Scale every row to unit length, so Euclidean distance ranks like cosine
+def normalize_rows(embeddings: np.ndarray) -> np.ndarray:
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return embeddings / norms
+
+
+# Choose the number of clusters for n items
+def choose_k(n: int, n_clusters=None, target_cluster_size=8) -> int:
+    if n_clusters is None:
+        n_clusters = math.ceil(n / target_cluster_size)
+    return max(1, min(n_clusters, n))
+
+
+# Cluster embedding rows and return one label per row
+def cluster_embeddings(
+    embeddings: np.ndarray,
+    n_clusters=None,
+    method="spherical",
+    target_cluster_size=8,
+    random_state=42,
+) -> np.ndarray:
+    if method not in METHODS:
+        raise ValueError(
+            f"Invalid clustering method: {method}. Must be one of {METHODS}"
+        )
+    n = len(embeddings)
+    k = choose_k(n, n_clusters, target_cluster_size)
+    if k == 1:
+        return np.zeros(n, dtype=int)
+    if k == n:
+        return np.arange(n)
+
+    if method == "kmeans":
+        from sklearn.cluster import KMeans
+
+        model = KMeans(n_clusters=k, random_state=random_state)
+        return model.fit(embeddings).labels_
+
+    if method == "spherical":
+        # k-means on unit vectors, so that clusters follow cosine similarity
+        embeddings = normalize_rows(embeddings)
+    else:
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+
+    if n < LARGE_LIST_SIZE:
+        return _fit_labels(embeddings, k, random_state)
+    return _two_level_labels(embeddings, k, random_state)
+
+
+# scikit-learn is imported on first use, since it is slow to import
+def _fit_labels(embeddings, k, random_state):
+    from sklearn.cluster import KMeans, MiniBatchKMeans
+
+    if k >= len(embeddings):
+        return np.arange(len(embeddings))
+    if len(embeddings) < LARGE_LIST_SIZE:
+        model = KMeans(n_clusters=k, random_state=random_state, n_init=1)
+    else:
+        model = MiniBatchKMeans(
+            n_clusters=k, random_state=random_state, batch_size=4096, n_init=3
+        )
+    return model.fit(embeddings).labels_
+
+
+# Cluster into about sqrt(k) coarse groups, then split every group in
+# proportion to its size. The cost grows with n * sqrt(k) instead of n * k.
+def _two_level_labels(embeddings, k, random_state):
+    n = len(embeddings)
+    coarse = _fit_labels(embeddings, math.ceil(math.sqrt(k)), random_state)
+    labels = np.empty(n, dtype=int)
+    next_label = 0
+    for group in np.unique(coarse):
+        members = np.flatnonzero(coarse == group)
+        group_k = max(1, round(k * len(members) / n))
+        if group_k == 1:
+            group_labels = np.zeros(len(members), dtype=int)
+        else:
+            group_labels = _fit_labels(embeddings[members], group_k, random_state)
+        labels[members] = group_labels + next_label
+        next_label += group_labels.max() + 1
+    return labels
@@ -0,0 +1,201 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import sqlite3
+import threading
+from openai.types.chat import ChatCompletion
+from OpenAIChatHelper import ChatCompletionEndPoint
+from OpenAIChatHelper.message import (
+    SubstitutionDict,
+    MessageList,
+    AssistantMessage,
+    TextContent,
+)
+import telemetry
+
+# Number of insertions between two eviction passes
+EVICT_EVERY = 100
+
+
+class CompletionCache:
+    """
+    SQLite-backed store of completion results.
+
+    Entries older than ttl_days are treated as missing, and once the table
+    grows past max_entries the least recently used entries are evicted.
+    """
+
+    def __init__(
+        self, path=".cache/completions.sqlite", ttl_days=30, max_entries=100000
+    ):
+        self.path = path
+        self.ttl = ttl_days * 24 * 3600 if ttl_days is not None else None
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._puts = 0
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS completions ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+            "created REAL NOT NULL, used REAL NOT NULL)"
+        )
+        self._db.commit()
+
+    def get(self, key: str):
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                "SELECT value, created FROM completions WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and self.ttl is not None and now - row[1] > self.ttl:
+                self._db.execute("DELETE FROM completions WHERE key = ?", (key,))
+                self._db.commit()
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self._db.execute(
+                "UPDATE completions SET used = ? WHERE key = ?", (now, key)
+            )
+            self._db.commit()
+            self.hits += 1
+            return json.loads(row[0])
+
+    def delete(self, key: str):
+        with self._lock:
+            self._db.execute("DELETE FROM completions WHERE key = ?", (key,))
+            self._db.commit()
+
+    def put(self, key: str, value):
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO completions VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), now, now),
+            )
+            self._puts += 1
+            if self.max_entries is not None and self._puts % EVICT_EVERY == 0:
+                # Keep only the most recently used entries
+                self._db.execute(
+                    "DELETE FROM completions WHERE key NOT IN "
+                    "(SELECT key FROM completions ORDER BY used DESC LIMIT ?)",
+                    (self.max_entries,),
+                )
+            self._db.commit()
+
+    # Log and reset the hit/miss counters
+    def log_stats(self, label="Completion cache"):
+        logging.info(f"{label}: {self.hits} hits, {self.misses} misses")
+        self.hits = 0
+        self.misses = 0
+
+
+class CachedChatCompletionEndPoint:
+    """
+    Wraps a ChatCompletionEndPoint and serves deterministic (temperature 0)
+    completions from a CompletionCache. The cache key covers the model, the
+    fully rendered messages and every sampling parameter.
+    """
+
+    def __init__(self, chatbot: ChatCompletionEndPoint, cache: CompletionCache):
+        self.chatbot = chatbot
+        self.cache = cache
+        self._default_model = chatbot._default_model
+
+    # Cache key of a request, or None if the request is not deterministic
+    def key(
+        self,
+        message_list: MessageList,
+        substitution_dict: SubstitutionDict = None,
+        model: str = None,
+        **kwargs,
+    ):
+        # Only deterministic requests are safe to replay
+        if kwargs.get("temperature") != 0 or kwargs.get("n", 1) != 1:
+            return None
+        return completion_key(
+            model or self._default_model, message_list, substitution_dict, kwargs
+        )
+
+    # Cached (res, meta) response of a request, or None
+    def lookup(self, *args, **kwargs):
+        key = self.key(*args, **kwargs)
+        value = self.cache.get(key) if key is not None else None
+        return load_completion(value) if value is not None else None
+
+    # Cache the (res, meta) response of a request, if it is deterministic
+    def store(self, response, *args, **kwargs):
+        key = self.key(*args, **kwargs)
+        value = dump_completion(*response) if key is not None else None
+        if value is not None:
+            self.cache.put(key, value)
+
+    # Forget the cached response of a request, such as one that failed to
+    # parse, so that the request is sent again next time
+    def evict(self, *args, **kwargs):
+        key = self.key(*args, **kwargs)
+        if key is not None:
+            self.cache.delete(key)
+
+    def completions(
+        self,
+        message_list: MessageList,
+        substitution_dict: SubstitutionDict = None,
+        model: str = None,
+        **kwargs,
+    ):
+        response = self.lookup(message_list, substitution_dict, model, **kwargs)
+        if response is not None:
+            telemetry.mark_cached()
+            return response
+
+        response = self.chatbot.completions(
+            message_list, substitution_dict=substitution_dict, model=model, **kwargs
+        )
+        self.store(response, message_list, substitution_dict, model, **kwargs)
+        return response
+
+
+# Hash of everything that determines the result of a completion request
+def completion_key(model, message_list, substitution_dict, params) -> str:
+    request = {
+        "model": model,
+        "messages": message_list.to_dict(substitution_dict or SubstitutionDict()),
+        "params": params,
+    }
+    request = json.dumps(request, sort_keys=True, default=str)
+    return hashlib.sha256(request.encode("utf-8")).hexdigest()
+
+
+# Serialize the returned messages and metadata of a completion
+def dump_completion(res, meta) -> dict:
+    messages = []
+    for message in res:
+        contents = message.content or []
+        if not contents or not all(isinstance(c, TextContent) for c in contents):
+            return None  # Tool calls and refusals are not cached
+        texts = [content.text for content in contents]
+        messages.append(texts)
+    if hasattr(meta, "model_dump_json"):
+        meta = meta.model_dump_json()
+    else:
+        meta = None
+    return {"messages": messages, "meta": meta}
+
+
+# Rebuild the (res, meta) pair returned by ChatCompletionEndPoint.completions
+def load_completion(value: dict):
+    res = [
+        AssistantMessage([TextContent(text) for text in texts])
+        for texts in value["messages"]
+    ]
+    meta = value["meta"]
+    if meta is not None:
+        meta = ChatCompletion.model_validate_json(meta)
+    return res, meta
@@ -15,20 +15,31 @@ STEP_ORDER = [
     "identify_losses",
     "identify_hazards",
     "consolidate_hazards",
-    "divide_and_consolidate1",
-    "divide_and_consolidate2",
-    "divide_and_consolidate3",
+    "reduce_hazards",
 ]
 
+# Output file of every step, without the suffix of its output format
+STEP_RESULTS = {
+    "identify_stakeholders": "stakeholders",
+    "identify_values": "values",
+    "identify_losses": "losses",
+    "identify_hazards": "hazards",
+    "consolidate_hazards": "consolidated_hazards",
+    "reduce_hazards": "reduced_hazards",
+}
 
-def load_config(file_path="config.yml"):
+
+def load_config(file_path="config.yml", base=None):
     """
     Load configuration from a YAML file and determine which steps to skip
-    based on the provided checkpoint.
+    based on the provided checkpoint. Top-level sections missing from the file
+    are taken from the base configuration, if one is given.
     """
 
     with open(file_path, "r") as file:
         config = yaml.safe_load(file)
+    if base is not None:
+        config = {**base, **config}
 
     # Check if a checkpoint is defined and valid
     if config["checkpoint"] is not None and config["checkpoint"] != "None":
@@ -38,20 +49,22 @@ def load_config(file_path="config.yml"):
             )
 
         # Determine which steps to skip based on the checkpoint
-        skip_steps = []
-        for step in STEP_ORDER:
-            if step == config["checkpoint"]:
-                break
-            skip_steps.append(step)
-
-        config["skip_steps"] = skip_steps
-        logging.info(f"Skipping steps: {skip_steps}")
+        config["skip_steps"] = steps_before(config["checkpoint"])
+        logging.info(f"Skipping steps: {config['skip_steps']}")
     else:
         config["skip_steps"] = []
 
     return config
 
 
+def steps_before(step) -> list:
+    """
+    List the steps that run before the given step.
+    """
+
+    return STEP_ORDER[: STEP_ORDER.index(step)]
+
+
 def system_description(config) -> str:
     """
     Construct a textual description of the ML system from the configuration.
@@ -0,0 +1,100 @@
+import hashlib
+import logging
+import numpy as np
+from clustering import normalize_rows
+from embedding_cache import normalize_text
+
+
+# Hash of a hazard after normalizing whitespace, case and final punctuation
+def dedup_key(text: str) -> str:
+    text = normalize_text(text).casefold().rstrip(" .;")
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+# Drop exact duplicates, keeping the first occurrence of every hazard.
+# Returns the indices of the survivors and, for each, the indices it absorbed.
+def remove_exact_duplicates(hazard_list: list):
+    first = {}
+    survivors = []
+    absorbed = {}
+    for i, hazard in enumerate(hazard_list):
+        key = dedup_key(hazard)
+        if key in first:
+            absorbed[first[key]].append(i)
+        else:
+            first[key] = i
+            survivors.append(i)
+            absorbed[i] = []
+    return survivors, absorbed
+
+
+# Drop rows whose cosine similarity to an earlier surviving row reaches the
+# threshold. Similarities are computed as blocked matrix products, so memory
+# stays at block_size x block_size. Returns the surviving row indices and,
+# for every absorbed row, the surviving row that absorbed it.
+def remove_near_duplicates(embeddings: np.ndarray, threshold=0.95, block_size=1024):
+    vectors = normalize_rows(embeddings)
+    n = len(vectors)
+    kept = np.zeros(n, dtype=bool)
+    owner = {}
+    for start in range(0, n, block_size):
+        end = min(start + block_size, n)
+        block = vectors[start:end]
+        best = np.full(end - start, -1)
+        best_sim = np.full(end - start, -np.inf, dtype=np.float32)
+
+        # Compare with the survivors of all earlier blocks
+        for prev in range(0, start, block_size):
+            prev_kept = np.flatnonzero(kept[prev : prev + block_size]) + prev
+            if len(prev_kept) == 0:
+                continue
+            sims = block @ vectors[prev_kept].T
+            arg = sims.argmax(axis=1)
+            top = sims[np.arange(len(block)), arg]
+            better = top > best_sim
+            best[better] = prev_kept[arg[better]]
+            best_sim[better] = top[better]
+
+        # Resolve rows inside the block in order
+        inner = block @ block.T
+        block_kept = []
+        for i in range(end - start):
+            if block_kept:
+                sims = inner[i, block_kept]
+                j = int(sims.argmax())
+                if sims[j] > best_sim[i]:
+                    best[i] = start + block_kept[j]
+                    best_sim[i] = sims[j]
+            if best_sim[i] >= threshold:
+                owner[start + i] = int(best[i])
+            else:
+                kept[start + i] = True
+                block_kept.append(i)
+    return np.flatnonzero(kept), owner
+
+
+# Remove exact and near duplicate hazards. get_embeddings is only called for
+# the hazards left after exact deduplication. Returns the surviving hazards,
+# their embeddings, and a mapping from each survivor to the hazards it absorbed.
+def deduplicate(hazard_list: list, get_embeddings, threshold=0.95, block_size=1024):
+    survivors, absorbed = remove_exact_duplicates(hazard_list)
+    embeddings = get_embeddings([hazard_list[i] for i in survivors])
+    kept, owner = remove_near_duplicates(embeddings, threshold, block_size)
+
+    # Fold the absorbed rows, and what they absorbed, into their owners
+    for row, owner_row in owner.items():
+        i, j = survivors[row], survivors[owner_row]
+        absorbed[j].append(i)
+        absorbed[j].extend(absorbed.pop(i))
+
+    kept_list = [hazard_list[survivors[row]] for row in kept]
+    dedup_map = {}
+    for row in kept:
+        i = survivors[row]
+        if absorbed[i]:
+            dedup_map[hazard_list[i]] = [hazard_list[j] for j in sorted(absorbed[i])]
+    logging.info(
+        f"Deduplication kept {len(kept_list)} of {len(hazard_list)} hazards "
+        f"({len(hazard_list) - len(survivors)} exact, {len(owner)} near duplicates)"
+    )
+    return kept_list, embeddings[kept], dedup_map
@@ -1,17 +1,228 @@
-from openai import OpenAI
+import time
 import numpy as np
+from embedding_cache import cache_key
+from utils import estimate_tokens
+import telemetry
 
-# Initialize the OpenAI client
-client = OpenAI()
+# Optional on-disk cache checked before requesting embeddings
+cache = None
 
+# Model used for all embedding requests
+EMBEDDING_MODEL = "text-embedding-3-small"
 
-# Function to get the embedding vector of a given text
-def get_embedding(text: str) -> np.ndarray:
-    # Request an embedding from the OpenAI API using the specified model
-    response = client.embeddings.create(input=text, model="text-embedding-3-small")
+# Limits for packing texts into a single embeddings request
+MAX_BATCH_SIZE = 2048
+MAX_BATCH_TOKENS = 250000
+
+
+# Split texts into batches bounded by both input count and estimated tokens
+def make_batches(
+    texts: list, max_batch_size=MAX_BATCH_SIZE, max_batch_tokens=MAX_BATCH_TOKENS
+) -> list:
+    batches = []
+    batch = []
+    batch_tokens = 0
+    for i, text in enumerate(texts):
+        tokens = estimate_tokens(text)
+        if batch and (
+            len(batch) >= max_batch_size or batch_tokens + tokens > max_batch_tokens
+        ):
+            batches.append(batch)
+            batch = []
+            batch_tokens = 0
+        batch.append(i)
+        batch_tokens += tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+class OpenAIEmbeddingBackend:
+    """
+    Embeds texts with the OpenAI embeddings API. The client is created on
+    first use, so importing this module needs neither network nor API key.
+    """
+
+    cacheable = True
+    remote = True
+
+    def __init__(self, model=EMBEDDING_MODEL):
+        self.model = model
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            from openai import OpenAI
+
+            self._client = OpenAI()
+        return self._client
+
+    # Request embeddings for texts from the API, batched and in input order
+    def embed(self, texts: list) -> np.ndarray:
+        embeddings = None
+        for batch in make_batches(texts):
+            # Request embeddings for the whole batch in a single API call
+            response = self.client.embeddings.create(
+                input=[texts[i] for i in batch], model=self.model
+            )
+
+            # The API reports the input position of every vector, keep input order
+            for data in response.data:
+                vector = np.asarray(data.embedding, dtype=np.float32)
+                if embeddings is None:
+                    embeddings = np.empty((len(texts), len(vector)), dtype=np.float32)
+                embeddings[batch[data.index]] = vector
+
+        return embeddings
+
+
+class LocalEmbeddingBackend:
+    """
+    Embeds texts on the CPU with scikit-learn, without any network access.
+
+    Word unigrams and bigrams are hashed into a sparse TF vector and reduced
+    to a dense vector in one vectorized pass. With the "projection" reducer a
+    fixed sparse random projection is used, so a text always gets the same
+    vector and results can be cached. With the "svd" reducer TF-IDF weights
+    and a TruncatedSVD are fitted on each call, which captures the structure
+    of the list being clustered but makes vectors depend on the whole call,
+    so they are never cached.
+    """
+
+    remote = False
+
+    def __init__(self, dimensions=256, n_features=2**16, reducer="projection"):
+        from sklearn.feature_extraction.text import HashingVectorizer
+
+        if reducer not in ["projection", "svd"]:
+            raise ValueError(
+                f"Invalid reducer: {reducer}. Must be one of ['projection', 'svd']"
+            )
+        self.dimensions = dimensions
+        self.reducer = reducer
+        self.cacheable = reducer == "projection"
+        self.model = f"local-{reducer}-{n_features}-{dimensions}"
+        self._vectorizer = HashingVectorizer(
+            n_features=n_features,
+            ngram_range=(1, 2),
+            alternate_sign=False,
+            norm="l2" if reducer == "projection" else None,
+        )
+        self._projection = None
+        if reducer == "projection":
+            from scipy.sparse import csr_matrix
+            from sklearn.random_projection import SparseRandomProjection
 
-    # Extract the embedding vector from the response
-    res = response.data[0].embedding
+            # Fitting only draws the random matrix for the input dimension. Every
+            # feature is spread over about 16 components, the default density of
+            # 1 / sqrt(n_features) would drop most features entirely.
+            self._projection = SparseRandomProjection(
+                n_components=dimensions,
+                density=min(1.0, 16 / dimensions),
+                dense_output=True,
+                random_state=42,
+            )
+            self._projection.fit(csr_matrix((1, n_features)))
 
-    # Convert the embedding list to a NumPy array and return it
-    return np.array(res)
+    def embed(self, texts: list) -> np.ndarray:
+        counts = self._vectorizer.transform(texts)
+        if self.reducer == "projection":
+            embeddings = self._projection.transform(counts)
+        else:
+            from sklearn.decomposition import TruncatedSVD
+            from sklearn.feature_extraction.text import TfidfTransformer
+
+            tfidf = TfidfTransformer(sublinear_tf=True).fit_transform(counts)
+            n_components = min(self.dimensions, len(texts) - 1, tfidf.shape[1] - 1)
+            embeddings = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+            if n_components >= 1:
+                svd = TruncatedSVD(n_components=n_components, random_state=42)
+                embeddings[:, :n_components] = svd.fit_transform(tfidf)
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return np.ascontiguousarray(embeddings / norms)
+
+
+# Embedding backends selectable in config.yml
+BACKENDS = {
+    "openai": OpenAIEmbeddingBackend,
+    "local": LocalEmbeddingBackend,
+}
+
+# Backend used for all embedding requests
+backend = OpenAIEmbeddingBackend()
+
+
+# Create the embedding backend named in config.yml, with the options of its
+# subsection. The subsections of the other backends are ignored.
+def make_backend(backend="openai", **sections):
+    if backend not in BACKENDS:
+        raise ValueError(
+            f"Invalid embedding backend: {backend}. Must be one of {list(BACKENDS)}"
+        )
+    unknown = [name for name in sections if name not in BACKENDS]
+    if unknown:
+        raise ValueError(
+            f"Unknown embedding options: {unknown}. Backend options go in the "
+            f"subsection of their backend, one of {list(BACKENDS)}"
+        )
+    return BACKENDS[backend](**(sections.get(backend) or {}))
+
+
+# Set the backend used by all embedding requests
+def set_backend(embedding_backend):
+    global backend
+    backend = embedding_backend
+
+
+# Set the embedding cache shared by all embedding requests
+def set_cache(embedding_cache):
+    global cache
+    cache = embedding_cache
+
+
+# Function to get the embedding vectors of a list of texts as a float32 matrix
+def get_embeddings(texts: list) -> np.ndarray:
+    texts = list(texts)
+    if not texts:
+        return np.empty((0, 0), dtype=np.float32)
+    start = time.perf_counter()
+    if cache is None or not backend.cacheable:
+        embeddings = backend.embed(texts)
+        telemetry.record_embeddings(
+            len(texts), 0, len(texts), time.perf_counter() - start
+        )
+        return embeddings
+
+    # Serve what we can from the cache and only request the rest
+    keys = [cache_key(backend.model, text) for text in texts]
+    found, missing = cache.lookup(keys)
+    cache_hits = len(found)
+    embedded = 0
+    if missing:
+        # Identical texts in one call are requested only once
+        unique = {}
+        for i in missing:
+            unique.setdefault(keys[i], i)
+        new_keys = list(unique)
+        embedded = len(new_keys)
+        new_embeddings = backend.embed([texts[unique[key]] for key in new_keys])
+        cache.add(new_keys, new_embeddings)
+        new_rows = {key: row for row, key in enumerate(new_keys)}
+        for i in missing:
+            found[i] = new_embeddings[new_rows[keys[i]]]
+
+    embeddings = np.empty((len(texts), len(found[0])), dtype=np.float32)
+    for i, vector in found.items():
+        embeddings[i] = vector
+    telemetry.record_embeddings(
+        len(texts), cache_hits, embedded, time.perf_counter() - start
+    )
+    return embeddings
+
+
+# Function to get the embedding vector of a given text
+def get_embedding(text: str) -> np.ndarray:
+    return get_embeddings([text])[0]
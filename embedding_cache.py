@@ -0,0 +1,148 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+import unicodedata
+import numpy as np
+from vector_file import VectorFile, file_lock
+
+VECTORS_FILE = "vectors.f32"
+INDEX_FILE = "index.jsonl"
+LOCK_FILE = "cache.lock"
+
+
+# Normalize text so that trivially different strings share one cache entry
+def normalize_text(text: str) -> str:
+    text = unicodedata.normalize("NFC", text)
+    return " ".join(text.split())
+
+
+# Content-addressed key of a text for a given embedding model
+def cache_key(model: str, text: str) -> str:
+    digest = hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+    return f"{model}:{digest}"
+
+
+class EmbeddingCache:
+    """
+    On-disk embedding store keyed by (model, normalized text hash).
+
+    Vectors are appended to a raw float32 file that is memory-mapped on load,
+    and every appended row is recorded in an append-only JSONL index. When the
+    number of rows exceeds max_entries the files are compacted, keeping the
+    entries used most recently.
+    """
+
+    def __init__(self, path=".cache/embeddings", max_entries=200000):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._clock = 0
+        os.makedirs(self.path, exist_ok=True)
+        self._load()
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    # Read the index and memory-map the vector file
+    def _load(self):
+        self._inode = self._index_inode()
+        self._index = {}
+        self._last_used = {}
+        dim = None
+        if os.path.exists(self._file(INDEX_FILE)):
+            with open(self._file(INDEX_FILE), "r") as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # Ignore a partially written last line
+                    dim = entry["dim"]
+                    self._index[entry["key"]] = entry["row"]
+        self._store = VectorFile(self._file(VECTORS_FILE), dim)
+        # Drop entries whose vectors never made it to disk
+        self._index = {k: r for k, r in self._index.items() if r < self._store.rows}
+
+    # Compaction replaces the index file, which changes its inode
+    def _index_inode(self):
+        try:
+            return os.stat(self._file(INDEX_FILE)).st_ino
+        except FileNotFoundError:
+            return None
+
+    def __len__(self):
+        return len(self._index)
+
+    # Look up keys, returning the cached vectors and the positions that missed
+    def lookup(self, keys: list):
+        found = {}
+        missing = []
+        with self._lock:
+            if self._index_inode() != self._inode:
+                self._load()  # Another process compacted the store
+            for i, key in enumerate(keys):
+                row = self._index.get(key)
+                if row is not None and row >= self._store.rows:
+                    self._store.map()
+                if row is None or row >= self._store.rows:
+                    missing.append(i)
+                    continue
+                found[i] = np.array(self._store.vectors[row], dtype=np.float32)
+                self._clock += 1
+                self._last_used[key] = self._clock
+            self.hits += len(found)
+            self.misses += len(missing)
+        return found, missing
+
+    # Append new vectors to the store
+    def add(self, keys: list, vectors: np.ndarray):
+        if len(keys) == 0:
+            return
+        # Serialize appends with other processes sharing the directory
+        with self._lock, file_lock(self._file(LOCK_FILE)):
+            if self._index_inode() != self._inode:
+                self._load()
+            start = self._store.append(vectors)
+            with open(self._file(INDEX_FILE), "a") as file:
+                for i, key in enumerate(keys):
+                    entry = {"key": key, "row": start + i, "dim": self._store.dim}
+                    file.write(json.dumps(entry) + "\n")
+                    self._index[key] = start + i
+                    self._clock += 1
+                    self._last_used[key] = self._clock
+            if self._inode is None:
+                self._inode = self._index_inode()
+            if self._store.rows > self.max_entries:
+                self._compact()
+
+    # Rewrite the store keeping the most recently used max_entries vectors
+    def _compact(self):
+        keys = sorted(
+            self._index,
+            key=lambda k: (self._last_used.get(k, 0), self._index[k]),
+            reverse=True,
+        )[: self.max_entries]
+        keys.sort(key=lambda k: self._index[k])
+        vectors = np.array(self._store.vectors[[self._index[k] for k in keys]])
+        tmp_index = self._file(INDEX_FILE + ".tmp")
+        with open(tmp_index, "w") as file:
+            for row, key in enumerate(keys):
+                entry = {"key": key, "row": row, "dim": self._store.dim}
+                file.write(json.dumps(entry) + "\n")
+        self._store.rewrite(vectors)
+        os.replace(tmp_index, self._file(INDEX_FILE))
+        self._inode = self._index_inode()
+        logging.info(
+            f"Embedding cache compacted from {len(self._index)} to {len(keys)} entries"
+        )
+        self._index = {key: row for row, key in enumerate(keys)}
+        self._last_used = {k: v for k, v in self._last_used.items() if k in self._index}
+
+    # Log and reset the hit/miss counters
+    def log_stats(self, label="Embedding cache"):
+        logging.info(f"{label}: {self.hits} hits, {self.misses} misses")
+        self.hits = 0
+        self.misses = 0
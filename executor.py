@@ -0,0 +1,328 @@
+import logging
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from OpenAIChatHelper import ChatCompletionEndPoint
+from OpenAIChatHelper.message import SubstitutionDict, MessageList
+from completion_cache import CachedChatCompletionEndPoint
+from journal import Journal, unit_key, prompt_inputs
+from structured import MODES, structure_request, retry_request
+import telemetry
+
+# Default number of requests running at the same time
+max_workers = 8
+
+# Caps the requests in flight across all fan-outs, including nested ones
+request_slots = threading.BoundedSemaphore(max_workers)
+
+# Optional BatchRunner taking over the fan-outs of its steps
+batch_runner = None
+
+# Optional TaskRunner handing the fan-outs of its steps to worker processes
+task_runner = None
+
+# Response format asked from steps with a schema, or None for text responses
+structured_mode = None
+
+# Times a request is sent again when its response fails to parse
+max_parse_retries = 0
+
+
+# Set the default concurrency limit used by all fan-out helpers
+def set_max_workers(n: int):
+    global max_workers, request_slots
+    if n < 1:
+        raise ValueError(f"max_workers must be at least 1, got {n}")
+    max_workers = n
+    request_slots = threading.BoundedSemaphore(n)
+
+
+# Send the fan-outs of the runner's steps through a batch endpoint
+def set_batch_runner(runner):
+    global batch_runner
+    batch_runner = runner
+
+
+# Send the fan-outs of the runner's steps to the workers of its task queue
+def set_task_runner(runner):
+    global task_runner
+    task_runner = runner
+
+
+# Ask for JSON responses validated against the schema of every step, with
+# mode one of MODES, or for text responses without a mode. Responses that fail
+# to parse are requested again up to max_retries times.
+def set_structured_output(mode=None, max_retries=2):
+    global structured_mode, max_parse_retries
+    if mode is not None and mode not in MODES:
+        raise ValueError(
+            f"Invalid structured output mode: {mode}. Must be one of {MODES}"
+        )
+    structured_mode = mode
+    max_parse_retries = max_retries
+
+
+# Parse the response to a request, and when it fails to parse send only this
+# request again, with the failed responses so far and their errors appended,
+# up to max_parse_retries times. Every failure is recorded in the telemetry,
+# and its response evicted from the completion cache, so that a later run
+# asks again instead of replaying it.
+def parse_response(
+    chatbot: ChatCompletionEndPoint,
+    message_list: MessageList,
+    context: SubstitutionDict,
+    response,
+    parse,
+    step: str = None,
+    label=None,
+    **kwargs,
+):
+    for attempt in range(max_parse_retries + 1):
+        try:
+            return parse(response)
+        except Exception as e:
+            telemetry.record_parse_failure(step)
+            if isinstance(chatbot, CachedChatCompletionEndPoint):
+                chatbot.evict(message_list, context, **kwargs)
+            if attempt == max_parse_retries:
+                raise
+            logging.warning(
+                f"Response of {step} could not be parsed ({e}), retry {attempt + 1}/{max_parse_retries}"
+            )
+            error = e
+        # Each retry extends the previous one, so a repeated failed response
+        # does not make it an identical request served from the cache
+        message_list = retry_request(message_list, response, error)
+        with request_slots, telemetry.track_request(step, label) as request:
+            request["response"] = chatbot.completions(
+                message_list, substitution_dict=context, **kwargs
+            )
+            response = request["response"]
+
+
+# Copy the shared substitution dictionary and apply per-request values
+def make_context(substitution_dict: SubstitutionDict, **values) -> SubstitutionDict:
+    context = SubstitutionDict()
+    for key, value in substitution_dict.items():
+        context[key] = value
+    for key, value in values.items():
+        context[key] = value
+    return context
+
+
+# Apply fn to every item concurrently, yielding results in input order. Every
+# item runs in a copy of the caller's context, so context variables such as
+# the telemetry step follow it into the worker threads.
+def imap_ordered(fn, items, workers=None):
+    items = list(items)
+    workers = min(workers or max_workers, len(items))
+    if workers <= 1:
+        for item in items:
+            yield fn(item)
+        return
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(contextvars.copy_context().run, fn, item) for item in items
+        ]
+        try:
+            for future in futures:
+                yield future.result()
+        finally:
+            # Do not start queued work once the caller stops consuming
+            for future in futures:
+                future.cancel()
+
+
+# Apply fn to every item concurrently and return the results in input order
+def map_ordered(fn, items, workers=None) -> list:
+    return list(imap_ordered(fn, items, workers=workers))
+
+
+# Send one completion request per substitution context, yielding the results in
+# input order as soon as they are ready.
+# With parse, the parsed result of each response is returned instead of the
+# raw (res, meta) pair, and with a journal every parsed result is recorded as
+# soon as it is ready so that finished units are reused after a restart.
+# Every request is recorded in the telemetry of the step, under the label of
+# its context (such as the stakeholder or cluster) when labels are given.
+# Steps handled by the batch runner are sent as one batch submission, and
+# steps handled by the task runner are queued for worker processes.
+# With a structured output mode, steps that give the kind of their schema
+# get JSON responses parsed with its parse function instead.
+def imap_completions(
+    chatbot: ChatCompletionEndPoint,
+    message_list: MessageList,
+    contexts: list,
+    workers=None,
+    parse=None,
+    journal: Journal = None,
+    step: str = None,
+    labels: list = None,
+    schema: str = None,
+    **kwargs,
+):
+    if journal is not None and (parse is None or step is None):
+        raise ValueError("Journaled completions need both a parse function and a step")
+    labels = labels or [None] * len(contexts)
+    if structured_mode is not None and schema is not None:
+        message_list, kwargs, parse = structure_request(
+            message_list, kwargs, schema, structured_mode
+        )
+
+    def complete(i):
+        with request_slots, telemetry.track_request(step, labels[i]) as request:
+            request["response"] = chatbot.completions(
+                message_list, substitution_dict=contexts[i], **kwargs
+            )
+            return request["response"]
+
+    def parse_unit(i, response):
+        return parse_response(
+            chatbot,
+            message_list,
+            contexts[i],
+            response,
+            parse,
+            step,
+            labels[i],
+            **kwargs,
+        )
+
+    # Fan-outs of batched steps are submitted together instead, and fan-outs
+    # of queued steps are sent and parsed by the workers
+    batched = batch_runner is not None and step in batch_runner.steps
+    queued = (
+        not batched and task_runner is not None and task_runner.handles(step, parse)
+    )
+
+    if journal is None:
+        if batched:
+            responses = batch_runner.run(
+                step, chatbot, message_list, contexts, kwargs, labels
+            )
+            for i, response in enumerate(responses):
+                yield response if parse is None else parse_unit(i, response)
+            return
+        if queued:
+            yield from task_runner.run(
+                step, chatbot._default_model, message_list, contexts, kwargs, parse
+            )
+            return
+        telemetry.expect_requests(step, len(contexts))
+        indices = range(len(contexts))
+        if parse is None:
+            yield from imap_ordered(complete, indices, workers=workers)
+        else:
+            yield from imap_ordered(
+                lambda i: parse_unit(i, complete(i)), indices, workers=workers
+            )
+        return
+
+    # Units are keyed by the fully rendered request, and recorded with the
+    # hashes of the inputs they were derived from for incremental runs
+    keys = [
+        unit_key(step, chatbot._default_model, message_list.to_dict(c), kwargs)
+        for c in contexts
+    ]
+    inputs = [
+        prompt_inputs(chatbot._default_model, message_list, c, kwargs) for c in contexts
+    ]
+    results = [None] * len(contexts)
+    pending = []
+    derived = 0
+    for i, key in enumerate(keys):
+        if (step, key) in journal:
+            results[i] = journal.get(step, key)
+        elif journal.has_derived(step, inputs[i]):
+            results[i] = journal.get_derived(step, inputs[i])
+            journal.record(step, key, results[i], inputs[i])
+            derived += 1
+        else:
+            pending.append(i)
+    if len(pending) < len(contexts):
+        logging.info(
+            f"Resuming {step}: {len(contexts) - len(pending)} of {len(contexts)} units found in journal"
+            + (f", {derived} with unchanged inputs" if derived else "")
+        )
+    if journal.incremental and pending and journal.has_inputs(step):
+        changed = {}
+        for i in pending:
+            for name in journal.changed_inputs(step, inputs[i]):
+                changed[name] = changed.get(name, 0) + 1
+        logging.info(
+            f"Recomputing {len(pending)} stale {step} units, changed inputs: {changed}"
+        )
+
+    if batched and pending:
+        responses = batch_runner.run(
+            step,
+            chatbot,
+            message_list,
+            [contexts[i] for i in pending],
+            kwargs,
+            [labels[i] for i in pending],
+        )
+        for i, response in zip(pending, responses):
+            results[i] = parse_unit(i, response)
+            journal.record(step, keys[i], results[i], inputs[i])
+        yield from results
+        return
+
+    if queued and pending:
+        computed = task_runner.run(
+            step,
+            chatbot._default_model,
+            message_list,
+            [contexts[i] for i in pending],
+            kwargs,
+            parse,
+        )
+        for i, result in zip(pending, computed):
+            results[i] = result
+            journal.record(step, keys[i], result, inputs[i])
+        yield from results
+        return
+
+    telemetry.expect_requests(step, len(pending))
+
+    def run_unit(i):
+        result = parse_unit(i, complete(i))
+        journal.record(step, keys[i], result, inputs[i])
+        return result
+
+    computed = imap_ordered(run_unit, pending, workers=workers)
+    pending = set(pending)
+    for i in range(len(contexts)):
+        if i in pending:
+            results[i] = next(computed)
+        yield results[i]
+
+
+# Send one completion request per substitution context, results in input order.
+# See imap_completions.
+def map_completions(
+    chatbot: ChatCompletionEndPoint,
+    message_list: MessageList,
+    contexts: list,
+    workers=None,
+    parse=None,
+    journal: Journal = None,
+    step: str = None,
+    labels: list = None,
+    schema: str = None,
+    **kwargs,
+) -> list:
+    return list(
+        imap_completions(
+            chatbot,
+            message_list,
+            contexts,
+            workers=workers,
+            parse=parse,
+            journal=journal,
+            step=step,
+            labels=labels,
+            schema=schema,
+            **kwargs,
+        )
+    )
@@ -0,0 +1,311 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import sqlite3
+import threading
+import numpy as np
+from clustering import normalize_rows
+from embedding import get_embeddings
+from embedding_cache import normalize_text
+from vector_file import VectorFile, file_lock
+
+# Kinds of entries recorded from every run
+KINDS = ["stakeholder", "loss", "hazard"]
+
+DATABASE_FILE = "index.sqlite"
+VECTORS_FILE = "vectors.f32"
+LOCK_FILE = "index.lock"
+
+# Rows of the vector matrix scored at once, to bound the memory of a search
+SEARCH_CHUNK_ROWS = 65536
+
+# Index of prior runs used by the steps, if configured
+index = None
+
+
+# Content-addressed key of an entry, so a text is recorded only once per kind
+def entry_key(*parts) -> str:
+    text = "\n".join(normalize_text(part) for part in parts if part is not None)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class HazardIndex:
+    """
+    Persistent index of the stakeholders, losses and hazards of past runs.
+
+    Entries are stored in SQLite and their unit-length embeddings in a raw
+    float32 matrix, memory-mapped for exact cosine similarity search. The
+    SQLite row of an entry is its row in the matrix, and vectors are written
+    before their entries, so a crash leaves at most some unused rows.
+    """
+
+    def __init__(self, path=".cache/hazard_index"):
+        self.path = path
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        self._db = sqlite3.connect(self._file(DATABASE_FILE), check_same_thread=False)
+        self._db.executescript(
+            "CREATE TABLE IF NOT EXISTS runs ("
+            "id INTEGER PRIMARY KEY, system TEXT NOT NULL, created REAL NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "row INTEGER PRIMARY KEY, run INTEGER NOT NULL, kind TEXT NOT NULL, "
+            "key TEXT NOT NULL, text TEXT NOT NULL, stakeholder TEXT, data TEXT, "
+            "UNIQUE (kind, key));"
+            "CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT);"
+        )
+        self._db.commit()
+        self._load()
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    # Memory-map the vector matrix and read the rows of every kind
+    def _load(self):
+        row = self._db.execute("SELECT value FROM meta WHERE name = 'dim'").fetchone()
+        self._store = VectorFile(
+            self._file(VECTORS_FILE), int(row[0]) if row is not None else None
+        )
+        self._size = self._store.size()
+        self._kind_rows = {
+            kind: self._entry_rows("kind = ?", (kind,)) for kind in KINDS
+        }
+
+    # Rows of the entries matching a condition whose vectors are on disk
+    def _entry_rows(self, condition, params) -> np.ndarray:
+        rows = self._db.execute(
+            f"SELECT row FROM entries WHERE {condition} AND row < ? ORDER BY row",
+            (*params, self._store.rows),
+        ).fetchall()
+        return np.array([r[0] for r in rows], dtype=np.int64)
+
+    # Reload when another process appended to the index
+    def _refresh(self):
+        if self._store.size() != self._size:
+            self._load()
+
+    def __len__(self):
+        with self._lock:
+            self._refresh()
+            return sum(len(rows) for rows in self._kind_rows.values())
+
+    # Add entries given as (kind, text, stakeholder, data) tuples, skipping
+    # those already in the index. Returns the number of entries added.
+    def add(self, run: int, entries: list) -> int:
+        keyed = {}
+        for kind, text, stakeholder, data in entries:
+            key = entry_key(text, stakeholder if kind == "loss" else None)
+            keyed.setdefault((kind, key), (kind, key, text, stakeholder, data))
+        with self._lock:
+            known = {
+                (kind, key)
+                for kind, key in keyed
+                if self._db.execute(
+                    "SELECT 1 FROM entries WHERE kind = ? AND key = ?", (kind, key)
+                ).fetchone()
+            }
+        entries = [entry for k, entry in keyed.items() if k not in known]
+        if not entries:
+            return 0
+        vectors = normalize_rows(get_embeddings([entry[2] for entry in entries]))
+
+        # Serialize appends with other processes sharing the index
+        with self._lock, file_lock(self._file(LOCK_FILE)):
+            self._load()
+            new_dim = self._store.dim is None
+            start = self._store.append(vectors)
+            if new_dim:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO meta VALUES ('dim', ?)",
+                    (str(self._store.dim),),
+                )
+            added = 0
+            for i, (kind, key, text, stakeholder, data) in enumerate(entries):
+                cursor = self._db.execute(
+                    "INSERT OR IGNORE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        start + i,
+                        run,
+                        kind,
+                        key,
+                        text,
+                        stakeholder,
+                        json.dumps(data) if data is not None else None,
+                    ),
+                )
+                added += cursor.rowcount
+            self._db.commit()
+            self._load()
+        return added
+
+    # Record the stakeholders, the hazards of every loss and the consolidated
+    # hazards of a finished run. Returns the id of the run.
+    def add_run(
+        self,
+        system: str,
+        stakeholders: list,
+        hazards: list,
+        consolidated_hazards: list,
+    ) -> int:
+        with self._lock:
+            cursor = self._db.execute(
+                "INSERT INTO runs (system, created) VALUES (?, ?)",
+                (system, time.time()),
+            )
+            self._db.commit()
+        run = cursor.lastrowid
+
+        entries = [
+            (
+                "stakeholder",
+                f"{item['name']} - {item['description']}",
+                item["name"],
+                None,
+            )
+            for item in stakeholders
+        ]
+        for item in hazards:
+            for loss, loss_hazards in item["hazards"].items():
+                entries.append(("loss", loss, item["name"], loss_hazards))
+        entries.extend(
+            ("hazard", hazard, None, None) for hazard in consolidated_hazards
+        )
+        added = self.add(run, entries)
+        logging.info(f"Hazard index: recorded run {run} with {added} new entries")
+        return run
+
+    # Exact search for the k rows of a kind most similar to each unit-length
+    # query vector, only among the entries of stakeholder if given. Returns
+    # lists of (row, similarity), most similar first.
+    def search(self, queries: np.ndarray, kind="hazard", k=5, stakeholder=None):
+        with self._lock:
+            self._refresh()
+            rows = self._kind_rows[kind]
+            if stakeholder is not None:
+                rows = self._entry_rows(
+                    "kind = ? AND stakeholder = ?", (kind, stakeholder)
+                )
+            vectors = self._store.vectors
+        if len(rows) == 0 or len(queries) == 0:
+            return [[] for _ in range(len(queries))]
+
+        best_rows = np.empty((len(queries), 0), dtype=np.int64)
+        best_scores = np.empty((len(queries), 0), dtype=np.float32)
+        for start in range(0, len(rows), SEARCH_CHUNK_ROWS):
+            chunk = rows[start : start + SEARCH_CHUNK_ROWS]
+            scores = queries @ np.asarray(vectors[chunk]).T
+            best_rows = np.hstack([best_rows, np.broadcast_to(chunk, scores.shape)])
+            best_scores = np.hstack([best_scores, scores])
+            if best_scores.shape[1] > k:
+                top = np.argpartition(-best_scores, k, axis=1)[:, :k]
+                best_rows = np.take_along_axis(best_rows, top, axis=1)
+                best_scores = np.take_along_axis(best_scores, top, axis=1)
+
+        order = np.argsort(-best_scores, axis=1)
+        best_rows = np.take_along_axis(best_rows, order, axis=1)
+        best_scores = np.take_along_axis(best_scores, order, axis=1)
+        return [
+            [(int(row), float(score)) for row, score in zip(r, s)]
+            for r, s in zip(best_rows, best_scores)
+        ]
+
+    # Find the k entries of a kind most similar to each text, at least
+    # min_similarity alike, only among the entries of stakeholder if given.
+    # Every match is a dict of the entry's text, stakeholder, data, run and
+    # similarity.
+    def query(
+        self, texts: list, kind="hazard", k=5, min_similarity=0.0, stakeholder=None
+    ) -> list:
+        texts = list(texts)
+        if not texts or len(self) == 0:
+            return [[] for _ in texts]
+        queries = normalize_rows(get_embeddings(texts))
+        dim = self._store.dim
+        if dim is not None and queries.shape[1] != dim:
+            raise ValueError(
+                f"Embedding dimension {queries.shape[1]} does not match index dimension {dim}"
+            )
+
+        results = []
+        for matches in self.search(queries, kind=kind, k=k, stakeholder=stakeholder):
+            matches = [(row, s) for row, s in matches if s >= min_similarity]
+            entries = {}
+            with self._lock:
+                for row, similarity in matches:
+                    text, stakeholder, data, run = self._db.execute(
+                        "SELECT text, stakeholder, data, run FROM entries WHERE row = ?",
+                        (row,),
+                    ).fetchone()
+                    entries[row] = {
+                        "text": text,
+                        "stakeholder": stakeholder,
+                        "data": json.loads(data) if data is not None else None,
+                        "run": run,
+                        "similarity": similarity,
+                    }
+            results.append([entries[row] for row, similarity in matches])
+        return results
+
+
+# Set the index of prior runs used by the steps
+def set_index(hazard_index: HazardIndex):
+    global index
+    index = hazard_index
+
+
+# For every loss of the given stakeholders, the hazards recorded for the most
+# similar prior loss if it is at least loss_similarity alike, else None. Only
+# the losses of stakeholders of the same name are matched, unless
+# same_stakeholder is false, and without loss_similarity nothing is reused.
+def retrieve_prior_hazards(
+    losses: list,
+    stakeholders: list,
+    loss_similarity=0.95,
+    same_stakeholder=True,
+    **options,
+) -> list:
+    prior = [None] * len(losses)
+    if index is None or loss_similarity is None:
+        return prior
+    groups = {}
+    for i, stakeholder in enumerate(stakeholders):
+        groups.setdefault(stakeholder if same_stakeholder else None, []).append(i)
+    for stakeholder, indices in groups.items():
+        matches = index.query(
+            [losses[i] for i in indices],
+            kind="loss",
+            k=1,
+            min_similarity=loss_similarity,
+            stakeholder=stakeholder,
+        )
+        for i, match in zip(indices, matches):
+            prior[i] = match[0]["data"] if match else None
+    return prior
+
+
+# Replace hazards by the wording of prior consolidated hazards at least
+# hazard_similarity alike, so that recurring hazards collapse into one entry
+# before clustering. Replaced hazards are recorded in dedup_map.
+def seed_hazard_list(
+    hazard_list: list, dedup_map: dict = None, hazard_similarity=0.95, **options
+) -> list:
+    if index is None or hazard_similarity is None or not hazard_list:
+        return hazard_list
+    matches = index.query(
+        hazard_list, kind="hazard", k=1, min_similarity=hazard_similarity
+    )
+    seeded = {}
+    for hazard, match in zip(hazard_list, matches):
+        prior = match[0]["text"] if match else hazard
+        seeded.setdefault(prior, [])
+        if prior != hazard:
+            seeded[prior].append(hazard)
+    if dedup_map is not None:
+        for prior, hazards in seeded.items():
+            if hazards:
+                dedup_map.setdefault(prior, []).extend(hazards)
+    logging.info(
+        f"Seeded {sum(len(h) for h in seeded.values())} of {len(hazard_list)} hazards with prior hazards"
+    )
+    return list(seeded)
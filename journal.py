@@ -0,0 +1,138 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+from OpenAIChatHelper.message import SubstitutionDict
+
+# Prompt inputs shared by every step, such as the system description
+SHARED_INPUTS = ["system_description"]
+
+
+class Journal:
+    """
+    Append-only JSONL record of every completed unit of work.
+
+    Each line holds the step, the key of the unit, the content hashes of the
+    prompt inputs it was derived from and its parsed result. A line is flushed
+    and synced to disk as soon as the unit finishes, so a crash only loses the
+    units that were still in flight.
+
+    With incremental, units are also reused after config.yml changed, as long
+    as the inputs they depend on are unchanged. A unit depends on its request
+    template, model and parameters and on the values its template uses, such
+    as its stakeholder or loss. The shared inputs, such as the system
+    description, only make the units of shared_input_steps stale. The other
+    steps depend on them through the upstream results they are given, so an
+    edited system description re-identifies the stakeholders, and every
+    stakeholder that comes out unchanged keeps its values, losses and hazards
+    even though their prompts used the old description.
+    """
+
+    def __init__(
+        self,
+        path="journal.jsonl",
+        incremental=False,
+        shared_input_steps=("identify_stakeholders",),
+    ):
+        self.path = path
+        self.incremental = incremental
+        self.shared_input_steps = list(shared_input_steps)
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._derived = {}
+        self._seen = {}
+        if os.path.exists(path):
+            with open(path, "r") as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # Ignore a partially written last line
+                    self._entries[(entry["step"], entry["key"])] = entry["result"]
+                    if entry.get("inputs") is not None:
+                        self._add_derived(
+                            entry["step"], entry["inputs"], entry["result"]
+                        )
+            logging.info(f"Loaded {len(self._entries)} journal entries from {path}")
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._file = open(path, "a")
+
+    def __contains__(self, unit):
+        return unit in self._entries
+
+    def get(self, step: str, key: str):
+        return self._entries[(step, key)]
+
+    # Inputs of a step that its units depend on
+    def tracked_inputs(self, step: str, inputs: dict) -> dict:
+        if step in self.shared_input_steps:
+            return inputs
+        return {k: v for k, v in inputs.items() if k not in SHARED_INPUTS}
+
+    def _add_derived(self, step, inputs, result):
+        tracked = self.tracked_inputs(step, inputs)
+        self._derived[(step, unit_key(tracked))] = result
+        for name, digest in tracked.items():
+            self._seen.setdefault((step, name), set()).add(digest)
+
+    # Whether an incremental run can reuse a unit derived from the same inputs
+    def has_derived(self, step: str, inputs: dict) -> bool:
+        if not self.incremental:
+            return False
+        return (step, unit_key(self.tracked_inputs(step, inputs))) in self._derived
+
+    def get_derived(self, step: str, inputs: dict):
+        return self._derived[(step, unit_key(self.tracked_inputs(step, inputs)))]
+
+    # Whether units of the step were recorded with their inputs
+    def has_inputs(self, step: str) -> bool:
+        with self._lock:
+            return any(s == step for s, name in self._seen)
+
+    # Names of the tracked inputs of a unit that no recorded unit of the step
+    # was derived from, explaining why the unit is stale
+    def changed_inputs(self, step: str, inputs: dict) -> list:
+        return [
+            name
+            for name, digest in self.tracked_inputs(step, inputs).items()
+            if digest not in self._seen.get((step, name), ())
+        ]
+
+    def record(self, step: str, key: str, result, inputs: dict = None):
+        line = json.dumps(
+            {"step": step, "key": key, "inputs": inputs, "result": result}
+        )
+        with self._lock:
+            self._entries[(step, key)] = result
+            if inputs is not None:
+                self._add_derived(step, inputs, result)
+            self._file.write(line + "\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+
+# Content hash identifying a unit of work from everything that determines it
+def unit_key(*parts) -> str:
+    content = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+# Content hashes of the prompt inputs of a unit: its request template with
+# the model and parameters, and every value the template uses. Values of the
+# context that the template leaves out do not make the unit stale.
+def prompt_inputs(model, message_list, context, params) -> dict:
+    placeholders = SubstitutionDict()
+    for name in context:
+        placeholders[name] = "{" + name + "}"
+    template = message_list.to_dict(placeholders)
+    inputs = {"request": unit_key(model, template, params)}
+    rendered = json.dumps(template)
+    for name, value in context.items():
+        if "{" + name + "}" in rendered:
+            inputs[name] = unit_key(value)
+    return inputs
@@ -2,17 +2,51 @@ from OpenAIChatHelper import ChatCompletionEndPoint
 from OpenAIChatHelper.message import (
     SubstitutionDict,
 )
-from config import load_config, system_description
+from config import load_config, system_description, STEP_ORDER
+from batch_api import make_batch_runner
+from completion_cache import CompletionCache, CachedChatCompletionEndPoint
+from embedding_cache import EmbeddingCache
+from executor import (
+    set_max_workers,
+    set_batch_runner,
+    set_task_runner,
+    set_structured_output,
+)
+from hazard_index import HazardIndex
+from online_consolidation import OnlineConsolidator
+from journal import Journal
+from reduce import reduce_hazards
+from pipeline import run_streaming_pipeline, split_stage_record, split_stage_outputs
+from scheduler import (
+    RequestScheduler,
+    RateLimitedEndPoint,
+    RateLimitedEmbeddingBackend,
+)
+from task_queue import make_task_runner
+from telemetry import Telemetry
+import embedding
+import hazard_index
+import telemetry
 from steps import (
     identify_stakeholders,
     identify_values,
     identify_losses,
     identify_hazards,
     consolidate_hazards,
-    divide_and_consolidate,
 )
-from utils import pause_execution, save_to_json, load_from_json
+from utils import (
+    pause_execution,
+    save_to_json,
+    load_from_json,
+    RecordWriter,
+    save_records,
+    load_records,
+    export_to_json,
+)
 import logging
+import os
+import sys
+import subprocess
 
 # Configure logging format and level
 logging.basicConfig(
@@ -22,125 +56,426 @@ logging.basicConfig(
 )
 
 
-def main():
-    # Load configuration settings
-    config = load_config()
+# Log the cache hit/miss counters collected during a step
+def log_cache_stats(chatbot, step):
+    if isinstance(chatbot, CachedChatCompletionEndPoint):
+        chatbot.cache.log_stats(f"Completion cache ({step})")
+    if embedding.cache is not None:
+        embedding.cache.log_stats(f"Embedding cache ({step})")
+
+
+# Save a step result in the configured output format, returning the file name
+def save_step(records, output_dir, name, output_config) -> str:
+    path = save_records(records, os.path.join(output_dir, name), **output_config)
+    return os.path.basename(path)
+
+
+# Read the records of a step result saved in any output format
+def load_step(output_dir, name):
+    return load_records(os.path.join(output_dir, name))
+
+
+# Start n worker processes for the task queue on this host, running
+# worker.py with the config file of the analysis
+def start_local_workers(n: int, config_path="config.yml") -> list:
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "worker.py")
+    command = [sys.executable, script, "--config", os.path.abspath(config_path)]
+    processes = [subprocess.Popen(command) for _ in range(n)]
+    logging.info(f"Started {n} local workers")
+    return processes
+
+
+# Create the chatbot and configure the shared caches and concurrency limits.
+# A chatbot can be given to run the analysis against another endpoint.
+def setup(config, chatbot=None):
+    # Create a chatbot interface using the specified model
+    if chatbot is None:
+        chatbot = ChatCompletionEndPoint(default_model=config["chatbot"]["model"])
+
+    # Limit the number of requests sent to the API at the same time
+    if config.get("concurrency") is not None:
+        set_max_workers(config["concurrency"]["max_workers"])
+
+    # Keep the requests and tokens of all analyses within the API budget,
+    # retrying rate limits and transient errors
+    if config.get("rate_limit") is not None:
+        chatbot = RateLimitedEndPoint(chatbot, RequestScheduler(**config["rate_limit"]))
+
+    # Select the embedding backend, the OpenAI API unless configured otherwise
+    if config.get("embedding") is not None:
+        embedding.set_backend(embedding.make_backend(**config["embedding"]))
+
+    # Schedule embedding requests within their own API budget. Backends that
+    # embed in this process have no budget to respect.
+    if config.get("embedding_rate_limit") is not None and embedding.backend.remote:
+        embedding.set_backend(
+            RateLimitedEmbeddingBackend(
+                embedding.backend, RequestScheduler(**config["embedding_rate_limit"])
+            )
+        )
+
+    # Reuse embeddings across consolidation rounds and across runs, in one
+    # store per embedding model since their vectors differ in size
+    if config.get("embedding_cache") is not None:
+        cache_config = dict(config["embedding_cache"])
+        cache_config["path"] = os.path.join(
+            cache_config.get("path", ".cache/embeddings"), embedding.backend.model
+        )
+        embedding.set_cache(EmbeddingCache(**cache_config))
+
+    # Record every run in the index of prior hazards, in one index per
+    # embedding model like the embedding cache
+    if config.get("hazard_index") is not None:
+        index_path = config["hazard_index"].get("path", ".cache/hazard_index")
+        hazard_index.set_index(
+            HazardIndex(os.path.join(index_path, embedding.backend.model))
+        )
+
+    # Send the requests of large fan-out steps through the batch endpoint. The
+    # streaming pipeline sends them directly, since every stakeholder would be
+    # a small batch of its own waiting on the poll interval.
+    if config.get("batch_api") is not None:
+        if (config.get("pipeline") or {}).get("streaming"):
+            logging.warning("The streaming pipeline does not use the batch API")
+        else:
+            set_batch_runner(make_batch_runner(**config["batch_api"]))
+
+    # Hand the requests of fan-out steps to worker processes through a
+    # shared task queue
+    if config.get("task_queue") is not None:
+        queue_config = dict(config["task_queue"])
+        queue_config.pop("local_workers", None)
+        queue_config.pop("workers", None)
+        set_task_runner(make_task_runner(**queue_config))
+
+    # Validate every response and request only the failed ones again
+    if config.get("structured_output") is not None:
+        set_structured_output(**config["structured_output"])
+
+    # Replay deterministic completions from previous runs
+    if config.get("completion_cache") is not None:
+        chatbot = CachedChatCompletionEndPoint(
+            chatbot, CompletionCache(**config["completion_cache"])
+        )
+
+    return chatbot
+
+
+# Export the telemetry of a run to the files configured in config.yml
+def save_telemetry(recorder, telemetry_config, output_dir):
+    if telemetry_config.get("report") is not None:
+        recorder.save_report(os.path.join(output_dir, telemetry_config["report"]))
+        logging.info(f"Run report saved to {telemetry_config['report']}")
+    if telemetry_config.get("prometheus") is not None:
+        recorder.save_prometheus(
+            os.path.join(output_dir, telemetry_config["prometheus"])
+        )
+
+
+# Run the analysis of the ML system described by config, writing every step
+# result to output_dir. Without interactive, steps run without pausing. With
+# last_step, the analysis stops after that step.
+def run_analysis(config, chatbot, output_dir=".", interactive=True, last_step=None):
+    os.makedirs(output_dir, exist_ok=True)
+    pause = pause_execution if interactive else lambda: None
+    run_steps = STEP_ORDER[: STEP_ORDER.index(last_step or STEP_ORDER[-1]) + 1]
+
+    # Step results are saved as JSONL records unless configured otherwise
+    output_config = config.get("output") or {}
+
+    # Similar losses and hazards of prior runs seed the hazard steps
+    retrieval = None
+    if hazard_index.index is not None:
+        retrieval = config["hazard_index"].get("retrieval")
 
     # Initialize substitution dictionary for prompt templating
     substitution_dict = SubstitutionDict()
 
-    # Create a chatbot interface using the specified model
-    chatbot = ChatCompletionEndPoint(default_model=config["chatbot"]["model"])
+    # Record every finished unit of work so an interrupted run can resume
+    journal = None
+    if config.get("journal") is not None:
+        journal_config = dict(config["journal"])
+        journal_path = os.path.join(output_dir, journal_config.pop("path"))
+        journal = Journal(journal_path, **journal_config)
+
+    # Record per-step latencies, tokens and cache hits of this analysis
+    recorder = None
+    telemetry_config = config.get("telemetry")
+    if telemetry_config is not None:
+        recorder = Telemetry(telemetry_config.get("progress_interval"))
+        telemetry.set_recorder(recorder)
+
+    # Export the telemetry once the last step to run finished
+    def finished(step) -> bool:
+        if step != last_step:
+            return False
+        if recorder is not None:
+            save_telemetry(recorder, telemetry_config, output_dir)
+        return True
+
+    # Hazards absorbed as duplicates during consolidation, by survivor. Rounds
+    # after a checkpoint keep adding to the map of the rounds they build on.
+    dedup_map = {}
+    dedup_map_path = os.path.join(output_dir, "dedup_map.json")
+    if "consolidate_hazards" in config["skip_steps"] and os.path.exists(dedup_map_path):
+        dedup_map = load_from_json(dedup_map_path)
 
     # Generate and log system description, and store in the substitution dictionary
     system_description_message = system_description(config)
     logging.info(f"System description: {system_description_message}")
     substitution_dict["system_description"] = system_description_message
-    pause_execution()
+    pause()
+
+    # With online consolidation, hazards are clustered and merged while they
+    # are identified, and step 5 only waits for the remaining merges
+    consolidator = None
+    if (
+        config.get("online_consolidation") is not None
+        and "consolidate_hazards" not in config["skip_steps"]
+        and "consolidate_hazards" in run_steps
+    ):
+        consolidator = OnlineConsolidator(
+            chatbot,
+            substitution_dict,
+            journal,
+            dedup=config.get("dedup"),
+            dedup_map=dedup_map,
+            packing=config.get("packing"),
+            retrieval=retrieval,
+            **config["online_consolidation"],
+        )
 
     # Step 1: Identify stakeholders unless skipped via config
     if "identify_stakeholders" not in config["skip_steps"]:
-        stakeholders = identify_stakeholders(chatbot, substitution_dict)
+        with telemetry.step("identify_stakeholders"):
+            stakeholders = identify_stakeholders(chatbot, substitution_dict, journal)
+        log_cache_stats(chatbot, "identify_stakeholders")
         for stakeholder in stakeholders:
             logging.info(
                 f"Stakeholder: {stakeholder['name']} - {stakeholder['description']}"
             )
-        save_to_json(stakeholders, "stakeholders.json")
-        logging.info("Stakeholders saved to stakeholders.json")
-        pause_execution()
+        name = save_step(stakeholders, output_dir, "stakeholders", output_config)
+        logging.info(f"Stakeholders saved to {name}")
+        pause()
     else:
-        stakeholders = load_from_json("stakeholders.json")
-        logging.info("Stakeholders loaded from stakeholders.json")
-
-    # Step 2: Identify values unless skipped
-    if "identify_values" not in config["skip_steps"]:
-        values = identify_values(chatbot, substitution_dict, stakeholders)
-        save_to_json(values, "values.json")
-        logging.info("Values saved to values.json")
-        pause_execution()
-    else:
-        values = load_from_json("values.json")
-        logging.info("Values loaded from values.json")
-
-    # Step 3: Identify losses unless skipped
-    if "identify_losses" not in config["skip_steps"]:
-        losses = identify_losses(chatbot, substitution_dict, values)
-        save_to_json(losses, "losses.json")
-        logging.info("Losses saved to losses.json")
-        pause_execution()
-    else:
-        losses = load_from_json("losses.json")
-        logging.info("Losses loaded from losses.json")
-
-    # Step 4: Identify hazards unless skipped
-    if "identify_hazards" not in config["skip_steps"]:
-        hazards = identify_hazards(chatbot, substitution_dict, losses)
-        save_to_json(hazards, "hazards.json")
-        logging.info("Hazards saved to hazards.json")
-        pause_execution()
+        stakeholders = list(load_step(output_dir, "stakeholders"))
+        logging.info("Stakeholders loaded")
+    if finished("identify_stakeholders"):
+        return
+
+    # Steps 2-4: Stream every stakeholder through values, losses and hazards
+    pipeline_config = config.get("pipeline") or {}
+    streamed_steps = ["identify_values", "identify_losses", "identify_hazards"]
+    if pipeline_config.get("streaming") and all(
+        step not in config["skip_steps"] and step in run_steps
+        for step in streamed_steps
+    ):
+        # Write the records of every stakeholder as soon as it leaves the
+        # pipeline, unless the results are saved as pretty-printed JSON
+        streamed_files = ["values", "losses", "hazards"]
+        compress = output_config.get("compress", False)
+        suffix = ".jsonl.gz" if compress else ".jsonl"
+        writers = []
+        if output_config.get("format", "jsonl") == "jsonl":
+            writers = [
+                RecordWriter(os.path.join(output_dir, name + suffix))
+                for name in streamed_files
+            ]
+
+        def write_record(record):
+            for writer, item in zip(writers, split_stage_record(record)):
+                writer.write(item)
+
+        try:
+            with telemetry.step("streaming_pipeline"):
+                records = run_streaming_pipeline(
+                    chatbot,
+                    substitution_dict,
+                    stakeholders,
+                    stage_workers=pipeline_config.get("stage_workers", 4),
+                    queue_size=pipeline_config.get("queue_size", 8),
+                    journal=journal,
+                    stage_options={
+                        "identify_losses": {"batching": config.get("loss_batching")},
+                        "identify_hazards": {
+                            "retrieval": retrieval,
+                            "consolidator": consolidator,
+                        },
+                    },
+                    on_record=write_record,
+                )
+        finally:
+            for writer in writers:
+                writer.close()
+        log_cache_stats(chatbot, "streaming_pipeline")
+        values, losses, hazards = split_stage_outputs(records)
+        for name, result in zip(streamed_files, [values, losses, hazards]):
+            base_path = os.path.join(output_dir, name)
+            if not writers:
+                save_step(result, output_dir, name, output_config)
+            elif output_config.get("export_json"):
+                export_to_json(base_path + suffix, base_path + ".json")
+        logging.info("Values, losses and hazards saved")
+        pause()
     else:
-        hazards = load_from_json("hazards.json")
-        logging.info("Hazards loaded from hazards.json")
+        # Step 2: Identify values unless skipped
+        if "identify_values" not in config["skip_steps"]:
+            with telemetry.step("identify_values"):
+                values = identify_values(
+                    chatbot, substitution_dict, stakeholders, journal
+                )
+            log_cache_stats(chatbot, "identify_values")
+            name = save_step(values, output_dir, "values", output_config)
+            logging.info(f"Values saved to {name}")
+            pause()
+        else:
+            values = list(load_step(output_dir, "values"))
+            logging.info("Values loaded")
+        if finished("identify_values"):
+            return
 
-    return
+        # Step 3: Identify losses unless skipped
+        if "identify_losses" not in config["skip_steps"]:
+            with telemetry.step("identify_losses"):
+                losses = identify_losses(
+                    chatbot,
+                    substitution_dict,
+                    values,
+                    journal,
+                    batching=config.get("loss_batching"),
+                )
+            log_cache_stats(chatbot, "identify_losses")
+            name = save_step(losses, output_dir, "losses", output_config)
+            logging.info(f"Losses saved to {name}")
+            pause()
+        else:
+            losses = list(load_step(output_dir, "losses"))
+            logging.info("Losses loaded")
+        if finished("identify_losses"):
+            return
+
+        # Step 4: Identify hazards unless skipped
+        if "identify_hazards" not in config["skip_steps"]:
+            with telemetry.step("identify_hazards"):
+                hazards = identify_hazards(
+                    chatbot,
+                    substitution_dict,
+                    losses,
+                    journal,
+                    retrieval=retrieval,
+                    consolidator=consolidator,
+                )
+            log_cache_stats(chatbot, "identify_hazards")
+            name = save_step(hazards, output_dir, "hazards", output_config)
+            logging.info(f"Hazards saved to {name}")
+            pause()
+        else:
+            # Streamed into consolidation one stakeholder at a time
+            hazards = load_step(output_dir, "hazards")
+            logging.info("Hazards loaded")
+    if finished("identify_hazards"):
+        return
 
     # Step 5: Consolidate hazards unless skipped
     if "consolidate_hazards" not in config["skip_steps"]:
-        consolidated_hazards = consolidate_hazards(chatbot, substitution_dict, hazards)
-        pause_execution()
-        save_to_json(consolidated_hazards, "consolidated_hazards.json")
-        logging.info("Consolidated hazards saved to consolidated_hazards.json")
-    else:
-        consolidated_hazards = load_from_json("consolidated_hazards.json")
-        logging.info("Consolidated hazards loaded from consolidated_hazards.json")
-
-    # Step 6: First round of divide and consolidate
-    if "divide_and_consolidate1" not in config["skip_steps"]:
-        consolidate_hazards1 = divide_and_consolidate(
-            chatbot,
-            substitution_dict,
-            consolidated_hazards,
-            n_clusters=10,
-            segment_size=min(100, len(consolidated_hazards)),
+        with telemetry.step("consolidate_hazards"):
+            if consolidator is None:
+                consolidated_hazards = consolidate_hazards(
+                    chatbot,
+                    substitution_dict,
+                    hazards,
+                    journal,
+                    clustering=config.get("clustering"),
+                    dedup=config.get("dedup"),
+                    dedup_map=dedup_map,
+                    packing=config.get("packing"),
+                    retrieval=retrieval,
+                )
+            else:
+                # Hazards loaded from a previous run are only streamed in now
+                if "identify_hazards" in config["skip_steps"]:
+                    for item in hazards:
+                        consolidator.start(item["name"], len(item["hazards"]))
+                        for loss_hazards in item["hazards"].values():
+                            consolidator.add(item["name"], loss_hazards)
+                consolidated_hazards = consolidator.finish(
+                    [item["name"] for item in stakeholders]
+                )
+        log_cache_stats(chatbot, "consolidate_hazards")
+        save_to_json(dedup_map, dedup_map_path)
+        pause()
+        name = save_step(
+            consolidated_hazards, output_dir, "consolidated_hazards", output_config
         )
-        pause_execution()
-        save_to_json(consolidate_hazards1, "consolidate_hazards1.json")
-        logging.info("Consolidated hazards saved to consolidate_hazards1.json")
+        logging.info(f"Consolidated hazards saved to {name}")
     else:
-        consolidate_hazards1 = load_from_json("consolidate_hazards1.json")
-        logging.info("Consolidated hazards loaded from consolidate_hazards1.json")
+        consolidated_hazards = list(load_step(output_dir, "consolidated_hazards"))
+        logging.info("Consolidated hazards loaded")
+    if finished("consolidate_hazards"):
+        return
 
-    # Step 7: Second round of divide and consolidate
-    if "divide_and_consolidate2" not in config["skip_steps"]:
-        consolidate_hazards2 = divide_and_consolidate(
-            chatbot,
-            substitution_dict,
-            consolidate_hazards1,
-            n_clusters=5,
-            segment_size=min(80, len(consolidate_hazards1)),
-        )
-        pause_execution()
-        save_to_json(consolidate_hazards2, "consolidate_hazards2.json")
-        logging.info("Consolidated hazards saved to consolidate_hazards2.json")
+    # Step 6: Reduce the consolidated hazards until the rounds converge
+    if "reduce_hazards" not in config["skip_steps"]:
+        with telemetry.step("reduce_hazards"):
+            reduced_hazards = reduce_hazards(
+                chatbot,
+                substitution_dict,
+                consolidated_hazards,
+                journal=journal,
+                clustering=config.get("clustering"),
+                dedup=config.get("dedup"),
+                dedup_map=dedup_map,
+                packing=config.get("packing"),
+                **(config.get("reduce") or {}),
+            )
+        log_cache_stats(chatbot, "reduce_hazards")
+        save_to_json(dedup_map, dedup_map_path)
+        pause()
+        name = save_step(reduced_hazards, output_dir, "reduced_hazards", output_config)
+        logging.info(f"Reduced hazards saved to {name}")
     else:
-        consolidate_hazards2 = load_from_json("consolidate_hazards2.json")
-        logging.info("Consolidated hazards loaded from consolidate_hazards2.json")
+        reduced_hazards = list(load_step(output_dir, "reduced_hazards"))
+        logging.info("Reduced hazards loaded")
 
-    # Step 8: Third round of divide and consolidate
-    if "divide_and_consolidate3" not in config["skip_steps"]:
-        consolidate_hazards3 = divide_and_consolidate(
-            chatbot,
-            substitution_dict,
-            consolidate_hazards2,
-            n_clusters=5,
-            segment_size=min(80, len(consolidate_hazards2)),
+    # Record the run in the index, for the analyses of similar systems
+    if hazard_index.index is not None:
+        with telemetry.step("hazard_index"):
+            hazard_index.index.add_run(
+                system_description_message,
+                load_step(output_dir, "stakeholders"),
+                load_step(output_dir, "hazards"),
+                reduced_hazards,
+            )
+
+    # Export the telemetry of the run
+    if recorder is not None:
+        save_telemetry(recorder, telemetry_config, output_dir)
+
+
+# Set up and run the analysis of config, loaded from config_path. See
+# run_analysis.
+def run(
+    config, output_dir=".", interactive=True, last_step=None, config_path="config.yml"
+):
+    chatbot = setup(config)
+
+    # Run workers for the task queue on this host too, if configured
+    workers = []
+    if (config.get("task_queue") or {}).get("local_workers"):
+        workers = start_local_workers(
+            config["task_queue"]["local_workers"], config_path
         )
-        pause_execution()
-        save_to_json(consolidate_hazards3, "consolidate_hazards3.json")
-        logging.info("Consolidated hazards saved to consolidate_hazards3.json")
-    else:
-        consolidate_hazards3 = load_from_json("consolidate_hazards3.json")
-        logging.info("Consolidated hazards loaded from consolidate_hazards3.json")
+    try:
+        run_analysis(config, chatbot, output_dir, interactive, last_step)
+    finally:
+        for process in workers:
+            process.terminate()
+
+
+def main():
+    # Load configuration settings
+    config = load_config()
+    run(config)
 
 
 # Entry point for the script
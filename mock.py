@@ -0,0 +1,277 @@
+import json
+import time
+import random
+import hashlib
+import threading
+from collections import deque
+import numpy as np
+from openai.types.chat import ChatCompletion
+from OpenAIChatHelper.message import (
+    SubstitutionDict,
+    MessageList,
+    AssistantMessage,
+    TextContent,
+)
+from embedding import make_batches
+from utils import estimate_tokens
+
+# Words synthetic answers are built from, so that answers overlap in content
+VOCABULARY = [
+    "access", "accuracy", "applicant", "audit", "bias", "consent", "data",
+    "delay", "disclosure", "error", "fairness", "failure", "job", "leak",
+    "misuse", "model", "outage", "privacy", "record", "review", "salary",
+    "security", "summary", "trust",
+]  # fmt: skip
+
+
+class MockRateLimitError(Exception):
+    """
+    Raised by the mock servers in place of an HTTP 429 response. Like the
+    OpenAI client errors it carries the status code, and the number of
+    seconds after which the request may be retried.
+    """
+
+    status_code = 429
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"Rate limit exceeded, retry after {retry_after:.2f}s")
+        self.retry_after = retry_after
+
+
+class MockServer:
+    """
+    Simulates the latency and rate limiting of an API server. Latency and
+    rate limit failures are drawn from a generator seeded by the request, so a
+    run is reproducible regardless of thread scheduling.
+    """
+
+    def __init__(
+        self,
+        latency=0.5,
+        jitter=0.2,
+        requests_per_minute=None,
+        rate_limit_rate=0.0,
+        seed=0,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.requests_per_minute = requests_per_minute
+        self.rate_limit_rate = rate_limit_rate
+        self.seed = seed
+        self.requests = 0
+        self.rate_limited = 0
+        self._attempts = {}
+        self._started = deque()
+        self._lock = threading.Lock()
+
+    # Random generator for the given attempt of a request
+    def rng(self, key: str, attempt=0) -> random.Random:
+        digest = hashlib.sha256(f"{self.seed}:{key}:{attempt}".encode()).hexdigest()
+        return random.Random(int(digest[:16], 16))
+
+    # Admit or reject a request, then wait for its simulated latency
+    def handle(self, key: str):
+        with self._lock:
+            attempt = self._attempts.get(key, 0)
+            self._attempts[key] = attempt + 1
+            rng = self.rng(key, attempt)
+
+            # Requests over the per-minute limit are rejected, like the API does
+            now = time.monotonic()
+            while self._started and now - self._started[0] >= 60:
+                self._started.popleft()
+            if (
+                self.requests_per_minute is not None
+                and len(self._started) >= self.requests_per_minute
+            ):
+                self.rate_limited += 1
+                raise MockRateLimitError(60 - (now - self._started[0]))
+            if rng.random() < self.rate_limit_rate:
+                self.rate_limited += 1
+                raise MockRateLimitError(1.0)
+            self._started.append(now)
+            self.requests += 1
+
+        time.sleep(max(0.0, self.latency + rng.uniform(-self.jitter, self.jitter)))
+        return rng
+
+
+class MockChatCompletionEndPoint:
+    """
+    Stand-in for ChatCompletionEndPoint that answers every step of the
+    analysis with synthetic lists, without network access or API costs.
+    Answers depend only on the rendered request, so repeated runs produce the
+    same results. The size of the analysis is set by the number of
+    stakeholders, values per stakeholder and hazards per loss returned, and
+    merge requests return merge_ratio of the hazards they are given.
+    Requests with a response_format are answered in the JSON of the
+    structured module, and malformed_rate of the answers cannot be parsed.
+    """
+
+    def __init__(
+        self,
+        default_model="mock",
+        n_stakeholders=8,
+        n_values=5,
+        n_hazards=5,
+        merge_ratio=0.5,
+        malformed_rate=0.0,
+        **server,
+    ):
+        self._default_model = default_model
+        self.n_stakeholders = n_stakeholders
+        self.n_values = n_values
+        self.n_hazards = n_hazards
+        self.merge_ratio = merge_ratio
+        self.malformed_rate = malformed_rate
+        self.server = MockServer(**server)
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self._lock = threading.Lock()
+
+    def completions(
+        self,
+        message_list: MessageList,
+        substitution_dict: SubstitutionDict = None,
+        model: str = None,
+        **kwargs,
+    ):
+        body = self.respond(
+            {
+                **kwargs,
+                "model": model or self._default_model,
+                "messages": message_list.to_dict(substitution_dict),
+            }
+        )
+        text = body["choices"][0]["message"]["content"]
+        return [AssistantMessage(TextContent(text))], ChatCompletion.model_validate(
+            body
+        )
+
+    # Answer a rendered chat completion request body with a response body, as
+    # the API would. Also used to answer the requests of local batches.
+    def respond(self, body: dict) -> dict:
+        texts = [
+            content["text"]
+            for message in body["messages"]
+            for content in message["content"]
+            if content.get("type") == "text"
+        ]
+        params = sorted((k, v) for k, v in body.items() if k != "messages")
+        key = repr((texts, params))
+        rng = self.server.handle(key)
+        # The request is the system prompt and the first user message, which
+        # are followed by the failed answer and the error when it is retried
+        user = next(
+            content["text"]
+            for message in body["messages"]
+            if message["role"] == "user"
+            for content in message["content"]
+        )
+        text = self.answer(texts[0], user, rng)
+        if body.get("response_format") is not None:
+            text = self.structure(texts[0], text)
+        if rng.random() < self.malformed_rate:
+            text = "Sorry, I am not sure how to answer this."
+
+        prompt_tokens = sum(estimate_tokens(t) for t in texts)
+        completion_tokens = estimate_tokens(text)
+        with self._lock:
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+        return {
+            "id": f"mock-{hashlib.sha256(key.encode()).hexdigest()[:24]}",
+            "object": "chat.completion",
+            "created": 0,
+            "model": body["model"],
+            "choices": [
+                {
+                    "index": 0,
+                    "finish_reason": "stop",
+                    "message": {"role": "assistant", "content": text},
+                }
+            ],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        }
+
+    # Synthetic answer to the step identified by the system prompt
+    def answer(self, system: str, user: str, rng: random.Random) -> str:
+        if "stakeholders" in system:
+            items = [
+                f"Stakeholder {i} - {self.phrase(rng)}"
+                for i in range(1, self.n_stakeholders + 1)
+            ]
+        elif "reverse each value" in system:
+            values = user.split("Values or goals:\n")[1].split("\n\n")[0]
+            items = [f"Loss of {self.phrase(rng)}" for _ in values.split("\n")]
+        elif "reverse the value" in system:
+            return f"Loss of {self.phrase(rng)}"
+        elif "Merge similar" in system:
+            hazards = [
+                line[2:]
+                for line in user.split("State or Condition List:\n")[1].split("\n")
+                if line.startswith("- ")
+            ]
+            n = max(1, round(len(hazards) * self.merge_ratio))
+            items = [f"Merged {hazard}" for hazard in rng.sample(hazards, n)]
+        elif "values and goals" in system:
+            items = [f"Value of {self.phrase(rng)}" for _ in range(self.n_values)]
+        else:
+            items = [f"State of {self.phrase(rng)}" for _ in range(self.n_hazards)]
+        return "\n".join(f"{i}. {item}" for i, item in enumerate(items, 1))
+
+    # The JSON answer of the structured module for a numbered list answer
+    def structure(self, system: str, text: str) -> str:
+        if "reverse the value" in system:
+            return json.dumps({"text": text})
+        items = [line.split(". ", 1)[1] for line in text.split("\n")]
+        if "stakeholders" in system:
+            stakeholders = [item.split(" - ", 1) for item in items]
+            return json.dumps(
+                {
+                    "stakeholders": [
+                        {"name": name, "description": description}
+                        for name, description in stakeholders
+                    ]
+                }
+            )
+        return json.dumps({"items": items})
+
+    # Short random phrase, unique enough to rarely collide between requests
+    def phrase(self, rng: random.Random) -> str:
+        words = rng.sample(VOCABULARY, 3)
+        return f"{' '.join(words)} {rng.randrange(10**6):06d}"
+
+
+class MockEmbeddingBackend:
+    """
+    Stand-in for the OpenAI embedding backend. Vectors are drawn from a
+    generator seeded by the text, and every batch request goes through a
+    MockServer with its own latency and rate limit.
+    """
+
+    cacheable = True
+    remote = True
+
+    def __init__(self, dimensions=64, **server):
+        self.dimensions = dimensions
+        self.model = f"mock-{dimensions}"
+        self.server = MockServer(**server)
+        self.inputs = 0
+        self._lock = threading.Lock()
+
+    def embed(self, texts: list) -> np.ndarray:
+        embeddings = np.empty((len(texts), self.dimensions), dtype=np.float32)
+        for batch in make_batches(texts):
+            key = hashlib.sha256("\n".join(texts[i] for i in batch).encode())
+            self.server.handle(key.hexdigest())
+            with self._lock:
+                self.inputs += len(batch)
+            for i in batch:
+                seed = int(hashlib.sha256(texts[i].encode()).hexdigest()[:16], 16)
+                embeddings[i] = np.random.default_rng(seed).normal(size=self.dimensions)
+        return embeddings
@@ -0,0 +1,239 @@
+import logging
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from OpenAIChatHelper import ChatCompletionEndPoint
+from OpenAIChatHelper.message import SubstitutionDict
+from clustering import choose_k, cluster_embeddings, normalize_rows
+from dedup import deduplicate
+from embedding import get_embeddings
+from hazard_index import seed_hazard_list
+from journal import Journal
+from packing import hazard_tokens, pack_clusters
+from steps import merge_hazard_clusters
+import executor
+import telemetry
+
+
+class _Stream:
+    """
+    Online clustering state of the hazards of one stakeholder. Hazards wait
+    in a buffer until there are enough to fit the centroids, after which
+    every batch updates them with MiniBatchKMeans.partial_fit and joins its
+    nearest cluster. task is the last batch being processed.
+    """
+
+    def __init__(self, key, batches):
+        self.key = key
+        self.batches = batches
+        self.received = 0
+        self.model = None
+        self.buffer = []
+        self.vectors = []
+        self.clusters = {}
+        self.ready = []
+        self.ready_tokens = 0
+        self.merges = 0
+        self.task = None
+
+
+class OnlineConsolidator:
+    """
+    Consolidates hazards while they are still being identified. The hazards
+    of every loss are embedded as they arrive and assigned to the clusters of
+    their stakeholder, and a cluster is merged as soon as it holds
+    cluster_size hazards, while the other losses are still generated. The
+    number of clusters of a stakeholder is estimated from its first loss so
+    that clusters hold about cluster_size hazards, as in consolidate_hazards,
+    unless n_clusters fixes it. When its last loss arrived, the clusters that did
+    not fill up are merged, packed into shared prompts if packing is given.
+    """
+
+    def __init__(
+        self,
+        chatbot: ChatCompletionEndPoint,
+        substitution_dict: SubstitutionDict,
+        journal: Journal = None,
+        cluster_size=8,
+        n_clusters=None,
+        random_state=42,
+        dedup: dict = None,
+        dedup_map: dict = None,
+        packing: dict = None,
+        retrieval: dict = None,
+    ):
+        self.chatbot = chatbot
+        self.substitution_dict = substitution_dict
+        self.journal = journal
+        self.cluster_size = cluster_size
+        self.n_clusters = n_clusters
+        self.random_state = random_state
+        self.dedup = dedup
+        self.dedup_map = dedup_map
+        self.packing = packing
+        self.retrieval = retrieval
+        self.hazard_num = 0
+        self._streams = {}
+        self._merges = []
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=executor.max_workers)
+
+    # Start the stream of a stakeholder, whose hazards arrive in batches
+    def start(self, key, batches: int):
+        with self._lock:
+            self._streams[key] = _Stream(key, batches)
+
+    # Add the hazards of one loss to the clusters of its stakeholder, without
+    # waiting for them to be embedded. The batches of a stakeholder are
+    # processed in the order they were added.
+    def add(self, key, hazards: list):
+        stream = self._streams[key]
+        context = contextvars.copy_context()
+        with self._lock:
+            stream.task = self._pool.submit(
+                context.run, self._add, stream, hazards, stream.task
+            )
+
+    def _add(self, stream, hazards, previous):
+        if previous is not None:
+            previous.result()
+        if self.retrieval is not None:
+            hazards = seed_hazard_list(hazards, self.dedup_map, **self.retrieval)
+        vectors = normalize_rows(get_embeddings(hazards)) if hazards else None
+
+        with self._lock:
+            self.hazard_num += len(hazards)
+            stream.received += 1
+            if hazards:
+                self._assign(stream, hazards, vectors)
+            full = [
+                label
+                for label, members in stream.clusters.items()
+                if len(members) >= self.cluster_size
+            ]
+            for label in full:
+                self._ready(stream, stream.clusters.pop(label))
+            # The last batch of a stakeholder merges its remaining clusters
+            if stream.received == stream.batches:
+                self._flush(stream)
+
+    # Merge a full cluster. With packing, full clusters wait until together
+    # they reach min_tokens, and are merged in one prompt of at most max_tokens.
+    def _ready(self, stream, members):
+        if self.packing is None:
+            self._merge(stream, [hazard for hazard, vector in members])
+            return
+        tokens = sum(hazard_tokens(hazard) for hazard, vector in members)
+        if stream.ready and stream.ready_tokens + tokens > self.packing.get(
+            "max_tokens", 2000
+        ):
+            self._merge(stream, [hazard for hazard, vector in stream.ready])
+            stream.ready, stream.ready_tokens = [], 0
+        stream.ready.extend(members)
+        stream.ready_tokens += tokens
+        if stream.ready_tokens >= self.packing.get("min_tokens", 200):
+            self._merge(stream, [hazard for hazard, vector in stream.ready])
+            stream.ready, stream.ready_tokens = [], 0
+
+    def _assign(self, stream, hazards, vectors):
+        if stream.model is None:
+            stream.buffer.extend(hazards)
+            stream.vectors.append(vectors)
+            # Estimate the size of the whole stakeholder from this loss
+            k = choose_k(
+                len(hazards) * stream.batches, self.n_clusters, self.cluster_size
+            )
+            if len(stream.buffer) < k or k == 1:
+                return
+            hazards, vectors = stream.buffer, np.vstack(stream.vectors)
+            stream.buffer, stream.vectors = [], []
+            from sklearn.cluster import MiniBatchKMeans
+
+            stream.model = MiniBatchKMeans(
+                n_clusters=k, random_state=self.random_state, n_init=3
+            )
+        stream.model.partial_fit(vectors)
+        for hazard, vector, label in zip(
+            hazards, vectors, stream.model.predict(vectors)
+        ):
+            stream.clusters.setdefault(int(label), []).append((hazard, vector))
+
+    # Merge every cluster that did not fill up, and the hazards never clustered
+    def _flush(self, stream):
+        groups = [members for label, members in sorted(stream.clusters.items())]
+        if stream.ready:
+            groups.append(stream.ready)
+        stream.clusters, stream.ready, stream.ready_tokens = {}, [], 0
+        if stream.buffer:
+            vectors = np.vstack(stream.vectors)
+            labels = cluster_embeddings(
+                vectors,
+                method="spherical",
+                target_cluster_size=self.cluster_size,
+                random_state=self.random_state,
+            )
+            for label in np.unique(labels):
+                groups.append(
+                    [
+                        (stream.buffer[i], vectors[i])
+                        for i in np.flatnonzero(labels == label)
+                    ]
+                )
+            stream.buffer, stream.vectors = [], []
+        if not groups:
+            return
+
+        hazard_list = [hazard for group in groups for hazard, vector in group]
+        indices = []
+        for group in groups:
+            start = sum(len(i) for i in indices)
+            indices.append(list(range(start, start + len(group))))
+        if self.packing is not None:
+            embeddings = np.vstack([vector for group in groups for h, vector in group])
+            indices = pack_clusters(indices, hazard_list, embeddings, **self.packing)
+        for group in indices:
+            self._merge(stream, [hazard_list[i] for i in group])
+
+    # Send the merge prompt of a cluster without waiting for its result
+    def _merge(self, stream, hazards):
+        position = (stream.key, stream.merges)
+        stream.merges += 1
+        context = contextvars.copy_context()
+        future = self._pool.submit(context.run, self._merge_cluster, hazards)
+        self._merges.append((position, future))
+
+    def _merge_cluster(self, hazards):
+        with telemetry.step("consolidate_hazards", timed=False):
+            if self.dedup is not None:
+                hazards, embeddings, absorbed = deduplicate(
+                    hazards, get_embeddings, **self.dedup
+                )
+                if self.dedup_map is not None:
+                    with self._lock:
+                        for survivor, duplicates in absorbed.items():
+                            self.dedup_map.setdefault(survivor, []).extend(duplicates)
+            return merge_hazard_clusters(
+                self.chatbot, self.substitution_dict, [hazards], journal=self.journal
+            )[0]
+
+    # Wait for every merge and return the consolidated hazards, by stakeholder
+    # in the order of keys, and by cluster in the order they were merged
+    def finish(self, keys: list) -> list:
+        order = {key: i for i, key in enumerate(keys)}
+        try:
+            for stream in list(self._streams.values()):
+                if stream.task is not None:
+                    stream.task.result()
+            merges = sorted(
+                self._merges,
+                key=lambda merge: (order.get(merge[0][0], len(order)), merge[0][1]),
+            )
+            hazard_list = []
+            for position, future in merges:
+                hazard_list.extend(future.result())
+        finally:
+            self._pool.shutdown(cancel_futures=True)
+        logging.info(f"Total number of hazards: {self.hazard_num}")
+        logging.info(f"Total number of consolidated hazards: {len(hazard_list)}")
+        return hazard_list
@@ -0,0 +1,74 @@
+import logging
+from clustering import cluster_embeddings
+from utils import estimate_tokens
+
+
+# Estimated prompt tokens of a hazard as it appears in the merge prompt
+def hazard_tokens(hazard: str) -> int:
+    return estimate_tokens(f"- {hazard}\n")
+
+
+# Split a cluster in two until every part fits in max_tokens. Parts are split
+# by 2-means on their embeddings when available, otherwise in halves.
+def split_cluster(indices: list, tokens, embeddings=None, max_tokens=2000) -> list:
+    if len(indices) < 2 or sum(tokens[i] for i in indices) <= max_tokens:
+        return [indices]
+
+    left, right = [], []
+    if embeddings is not None:
+        labels = cluster_embeddings(
+            embeddings[indices], n_clusters=2, method="spherical"
+        )
+        for i, label in zip(indices, labels):
+            (left if label == 0 else right).append(i)
+    if not left or not right:
+        half = len(indices) // 2
+        left, right = indices[:half], indices[half:]
+
+    return split_cluster(left, tokens, embeddings, max_tokens) + split_cluster(
+        right, tokens, embeddings, max_tokens
+    )
+
+
+# Reshape clusters so that every merge prompt falls in [min_tokens, max_tokens]
+# where possible. Oversized clusters are split recursively, and clusters below
+# min_tokens are bin-packed (first-fit decreasing) into shared prompts.
+# Clusters and the returned groups are lists of indices into hazard_list.
+def pack_clusters(
+    clusters: list,
+    hazard_list: list,
+    embeddings=None,
+    min_tokens=200,
+    max_tokens=2000,
+) -> list:
+    tokens = [hazard_tokens(hazard) for hazard in hazard_list]
+
+    groups = []
+    for cluster in clusters:
+        groups.extend(split_cluster(cluster, tokens, embeddings, max_tokens))
+
+    sizes = [sum(tokens[i] for i in group) for group in groups]
+    packed = [group for group, size in zip(groups, sizes) if size >= min_tokens]
+    small = [(size, group) for group, size in zip(groups, sizes) if size < min_tokens]
+
+    # Largest first, ties broken by position to keep the result deterministic
+    small.sort(key=lambda item: (-item[0], item[1][0]))
+    bins = []
+    for size, group in small:
+        for b in bins:
+            if b[0] + size <= max_tokens:
+                b[0] += size
+                b[1].extend(group)
+                break
+        else:
+            bins.append([size, list(group)])
+    packed.extend(b[1] for b in bins)
+
+    # Keep the prompts in the order of the hazards they start with
+    packed = [sorted(group) for group in packed]
+    packed.sort(key=lambda group: group[0])
+    logging.info(
+        f"Packed {len(clusters)} clusters into {len(packed)} merge prompts "
+        f"of {min_tokens}-{max_tokens} tokens"
+    )
+    return packed
@@ -0,0 +1,175 @@
+import time
+import queue
+import logging
+import threading
+import contextvars
+from OpenAIChatHelper import ChatCompletionEndPoint
+from OpenAIChatHelper.message import SubstitutionDict
+from journal import Journal
+import telemetry
+from steps import identify_values, identify_losses, identify_hazards
+
+# Steps every stakeholder flows through, and the keys each of them adds
+STAGES = [
+    ("identify_values", identify_values, "values"),
+    ("identify_losses", identify_losses, "losses"),
+    ("identify_hazards", identify_hazards, "hazards"),
+]
+
+# Marks the end of the stream between two stages
+_DONE = object()
+
+
+# Worker loop of a stage: process items until the upstream stage is done
+def _stage_worker(step, inbox: queue.Queue, outbox: queue.Queue):
+    while True:
+        job = inbox.get()
+        if job is _DONE:
+            break
+        index, item = job
+        if not isinstance(item, Exception):
+            try:
+                item = step(item)
+            except Exception as e:
+                # Pass the failure downstream so that the stream still drains
+                logging.error(f"Pipeline stage failed for stakeholder {index}: {e}")
+                item = e
+        outbox.put((index, item))
+
+
+# Start the workers of a stage and close its output once all of them finished.
+# Workers run in a copy of the caller's context, to keep its telemetry.
+def _start_stage(step, inbox, outbox, workers):
+    threads = [
+        threading.Thread(
+            target=contextvars.copy_context().run,
+            args=(_stage_worker, step, inbox, outbox),
+            daemon=True,
+        )
+        for _ in range(workers)
+    ]
+    for thread in threads:
+        thread.start()
+
+    def close():
+        for thread in threads:
+            thread.join()
+        outbox.put(_DONE)
+
+    threading.Thread(target=close, daemon=True).start()
+
+
+# Stream every stakeholder through values, losses and hazards as soon as its
+# upstream result is ready, instead of waiting for each step to finish.
+# stage_options maps a stage name to extra keyword arguments of its step, and
+# on_record is called with every finished record as soon as all records
+# before it are finished, so that results can be written while others run.
+def run_streaming_pipeline(
+    chatbot: ChatCompletionEndPoint,
+    substitution_dict: SubstitutionDict,
+    stakeholders: list,
+    stage_workers=4,
+    queue_size=8,
+    journal: Journal = None,
+    stage_options: dict = None,
+    on_record=None,
+) -> list:
+    # Bounded queues between stages provide backpressure
+    queues = [queue.Queue(maxsize=queue_size) for _ in range(len(STAGES))]
+    queues.append(queue.Queue())
+
+    # Stages work on several stakeholders at once, so each stage is timed once
+    # from its first start to its last end instead of per stakeholder
+    spans = {}
+    spans_lock = threading.Lock()
+
+    for i, (name, step, key) in enumerate(STAGES):
+
+        def run_step(item, name=name, step=step):
+            options = (stage_options or {}).get(name, {})
+            start = time.perf_counter()
+            try:
+                with telemetry.step(name, timed=False):
+                    return step(
+                        chatbot, substitution_dict, [item], journal=journal, **options
+                    )[0]
+            finally:
+                end = time.perf_counter()
+                with spans_lock:
+                    first, last = spans.get(name, (start, end))
+                    spans[name] = (min(first, start), max(last, end))
+
+        # Every worker of the next stage needs its own end-of-stream marker
+        next_workers = stage_workers if i + 1 < len(STAGES) else 1
+        outbox = _Fanout(queues[i + 1], next_workers)
+        _start_stage(run_step, queues[i], outbox, stage_workers)
+
+    def feed():
+        for index, item in enumerate(stakeholders):
+            queues[0].put((index, item))
+        for _ in range(stage_workers):
+            queues[0].put(_DONE)
+
+    threading.Thread(target=feed, daemon=True).start()
+
+    # Collect the results, restoring the original stakeholder order
+    results = [None] * len(stakeholders)
+    finished = [False] * len(stakeholders)
+    next_index = 0
+    while True:
+        job = queues[-1].get()
+        if job is _DONE:
+            break
+        index, item = job
+        results[index] = item
+        finished[index] = True
+        logging.info(f"Pipeline finished stakeholder {index + 1}/{len(stakeholders)}")
+        while next_index < len(results) and finished[next_index]:
+            if on_record is not None and not isinstance(results[next_index], Exception):
+                on_record(results[next_index])
+            next_index += 1
+
+    for name, (start, end) in spans.items():
+        telemetry.add_wall_time(name, end - start)
+
+    for item in results:
+        if isinstance(item, Exception):
+            raise item
+    return results
+
+
+class _Fanout:
+    """
+    Output side of a stage. Items are forwarded to the next queue, and the
+    end-of-stream marker is repeated once per worker of the next stage.
+    """
+
+    def __init__(self, outbox: queue.Queue, workers: int):
+        self.outbox = outbox
+        self.workers = workers
+
+    def put(self, job):
+        if job is _DONE:
+            for _ in range(self.workers):
+                self.outbox.put(_DONE)
+        else:
+            self.outbox.put(job)
+
+
+# Split a streamed record into the per-step records saved by main
+def split_stage_record(record: dict) -> list:
+    outputs = []
+    keys = ["name", "description"]
+    for name, step, key in STAGES:
+        keys = keys + [key]
+        outputs.append({k: record[k] for k in keys if k in record})
+    return outputs
+
+
+# Split the streamed records into the per-step outputs saved by main
+def split_stage_outputs(records: list) -> list:
+    outputs = [[] for _ in STAGES]
+    for record in records:
+        for output, item in zip(outputs, split_stage_record(record)):
+            output.append(item)
+    return outputs
@@ -0,0 +1,95 @@
+import logging
+import numpy as np
+from OpenAIChatHelper import ChatCompletionEndPoint
+from OpenAIChatHelper.message import SubstitutionDict
+from clustering import normalize_rows
+from embedding import get_embeddings
+from journal import Journal
+from steps import cluster_hazard_list, merge_hazard_clusters
+
+
+# Split rows into segments of at most segment_size by recursive bisection at
+# the median of their projection on the first principal component. Nearby
+# hazards end up in the same segment, and the split is deterministic.
+def bisect_segments(embeddings: np.ndarray, indices: list, segment_size: int) -> list:
+    if len(indices) <= segment_size:
+        return [indices]
+    vectors = embeddings[indices]
+    vectors = vectors - vectors.mean(axis=0)
+    _, _, vt = np.linalg.svd(vectors, full_matrices=False)
+    direction = vt[0]
+    # Fix the sign of the component so that the order does not flip between runs
+    direction = direction * np.sign(direction[np.abs(direction).argmax()])
+    order = np.argsort(vectors @ direction, kind="stable")
+    half = len(indices) // 2
+    left = sorted(indices[i] for i in order[:half])
+    right = sorted(indices[i] for i in order[half:])
+    return bisect_segments(embeddings, left, segment_size) + bisect_segments(
+        embeddings, right, segment_size
+    )
+
+
+# Consolidate hazards round after round, merging the clusters of every
+# embedding-local segment concurrently, until a round reduces the list by less
+# than min_reduction, the list has at most target_count hazards, or max_rounds
+# rounds have run
+def reduce_hazards(
+    chatbot: ChatCompletionEndPoint,
+    substitution_dict: SubstitutionDict,
+    hazard_list: list,
+    segment_size=100,
+    n_clusters=10,
+    min_reduction=0.1,
+    target_count=None,
+    max_rounds=5,
+    journal: Journal = None,
+    clustering: dict = None,
+    dedup: dict = None,
+    dedup_map: dict = None,
+    packing: dict = None,
+) -> list:
+    for round_num in range(1, max_rounds + 1):
+        if target_count is not None and len(hazard_list) <= target_count:
+            break
+        if len(hazard_list) <= 1:
+            break
+
+        embeddings = normalize_rows(get_embeddings(hazard_list))
+        segments = bisect_segments(
+            embeddings, list(range(len(hazard_list))), segment_size
+        )
+        logging.info(
+            f"Reduce round {round_num}: {len(hazard_list)} hazards in {len(segments)} segments"
+        )
+
+        clusters = []
+        for segment in segments:
+            clusters.extend(
+                cluster_hazard_list(
+                    [hazard_list[i] for i in segment],
+                    n_clusters=n_clusters,
+                    dedup=dedup,
+                    dedup_map=dedup_map,
+                    packing=packing,
+                    **(clustering or {}),
+                )
+            )
+
+        # Merge the clusters of all segments concurrently
+        reduced = []
+        for merged in merge_hazard_clusters(
+            chatbot, substitution_dict, clusters, journal=journal
+        ):
+            reduced.extend(merged)
+
+        reduction = 1 - len(reduced) / len(hazard_list)
+        logging.info(
+            f"Reduce round {round_num}: {len(hazard_list)} -> {len(reduced)} hazards "
+            f"({reduction:.0%} reduction)"
+        )
+        if reduction <= 0:
+            break  # Keep the previous list when a round does not help
+        hazard_list = reduced
+        if reduction < min_reduction:
+            break
+    return hazard_list
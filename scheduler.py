@@ -0,0 +1,301 @@
+import time
+import random
+import logging
+import threading
+import numpy as np
+from OpenAIChatHelper import ChatCompletionEndPoint
+from OpenAIChatHelper.message import SubstitutionDict, MessageList
+from embedding import make_batches
+from utils import estimate_tokens
+import telemetry
+
+# HTTP status codes worth retrying: rate limits and transient server errors
+RETRY_STATUS_CODES = [408, 409, 429, 500, 502, 503, 504]
+
+# Exception names of transient network failures of the OpenAI client
+RETRY_ERRORS = ["APITimeoutError", "APIConnectionError", "Timeout", "TimeoutError"]
+
+
+class TokenBucket:
+    """
+    Token bucket refilled at rate_per_minute, holding at most one second of
+    budget or the largest single request, whichever is larger.
+    """
+
+    def __init__(self, rate_per_minute):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = max(1.0, self.rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+
+    # Refill the bucket and return the seconds until amount tokens are there
+    def wait_time(self, amount, now) -> float:
+        self._tokens = min(
+            max(self.capacity, amount), self._tokens + (now - self._updated) * self.rate
+        )
+        self._updated = now
+        return max(0.0, (amount - self._tokens) / self.rate)
+
+    def take(self, amount):
+        self._tokens -= amount
+
+
+class RateLimiter:
+    """
+    Token buckets limiting the requests and the estimated tokens started per
+    minute, each unlimited when None. One limiter can be shared by every
+    analysis running in the process.
+    """
+
+    def __init__(self, requests_per_minute=500, tokens_per_minute=None):
+        self._buckets = []
+        if requests_per_minute is not None:
+            self._buckets.append((TokenBucket(requests_per_minute), False))
+        if tokens_per_minute is not None:
+            self._buckets.append((TokenBucket(tokens_per_minute), True))
+        self._lock = threading.Lock()
+
+    # Block until a request of the given estimated tokens may be started. Both
+    # budgets are taken together, so waiting for one does not waste the other.
+    def acquire(self, tokens=0):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                wait = 0.0
+                for bucket, counts_tokens in self._buckets:
+                    wait = max(
+                        wait, bucket.wait_time(tokens if counts_tokens else 1, now)
+                    )
+                if wait == 0:
+                    for bucket, counts_tokens in self._buckets:
+                        bucket.take(tokens if counts_tokens else 1)
+                    return
+            time.sleep(wait)
+
+
+class AdaptiveConcurrency:
+    """
+    Limits the requests in flight with additive increase and multiplicative
+    decrease. The limit grows by one per window of successful requests, and
+    is cut by decrease_factor on a rate limit response or when the smoothed
+    latency exceeds latency_factor times the lowest smoothed latency seen
+    since the last cut.
+    Cuts happen at most once per cooldown, since the requests already in
+    flight report the same congestion.
+    """
+
+    def __init__(
+        self,
+        initial=8,
+        min_limit=1,
+        max_limit=64,
+        decrease_factor=0.5,
+        latency_factor=3.0,
+        min_samples=20,
+        cooldown=5.0,
+    ):
+        self.limit = float(max(min_limit, min(initial, max_limit)))
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.decrease_factor = decrease_factor
+        self.latency_factor = latency_factor
+        self.min_samples = min_samples
+        self.cooldown = cooldown
+        self.active = 0
+        self._latency = None
+        self._baseline = None
+        self._samples = 0
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while self.active >= int(self.limit):
+                self._condition.wait()
+            self.active += 1
+
+    def release(self):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify()
+
+    # Additive increase after a successful request, unless latency shows
+    # that the provider is already saturated. The latency baseline is only
+    # trusted after min_samples requests at the current level.
+    def on_success(self, latency):
+        with self._condition:
+            self._samples += 1
+            if self._latency is None:
+                self._latency = latency
+            else:
+                self._latency = 0.9 * self._latency + 0.1 * latency
+            if self._samples >= self.min_samples and (
+                self._baseline is None or self._latency < self._baseline
+            ):
+                self._baseline = self._latency
+            if (
+                self._baseline is not None
+                and self._latency > self.latency_factor * self._baseline
+            ):
+                self._decrease("high latency")
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+    # Multiplicative decrease after a rate limit response
+    def on_rate_limit(self):
+        with self._condition:
+            self._decrease("rate limit")
+
+    def _decrease(self, reason):
+        now = time.monotonic()
+        if now - self._last_decrease < self.cooldown:
+            return
+        self._last_decrease = now
+        # Forget the latency history so the new level sets its own baseline
+        self._latency = self._baseline = None
+        self._samples = 0
+        if self.limit > self.min_limit:
+            self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+            logging.info(f"Concurrency limit lowered to {int(self.limit)} ({reason})")
+
+
+# Whether a failed request is worth retrying
+def is_retryable(error: Exception) -> bool:
+    if getattr(error, "status_code", None) in RETRY_STATUS_CODES:
+        return True
+    return type(error).__name__ in RETRY_ERRORS
+
+
+# Seconds the provider asked to wait before retrying, if it said
+def retry_after(error: Exception):
+    if getattr(error, "retry_after", None) is not None:
+        return float(error.retry_after)
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class RequestScheduler:
+    """
+    Runs API requests within rate budgets and an adaptive concurrency limit,
+    retrying rate limits, timeouts and server errors with jittered exponential
+    backoff. Completions and embeddings each have their own scheduler, since
+    the provider budgets them separately.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute=500,
+        tokens_per_minute=None,
+        max_retries=6,
+        base_delay=1.0,
+        max_delay=60.0,
+        concurrency: dict = None,
+    ):
+        self.limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+        self.concurrency = AdaptiveConcurrency(**(concurrency or {}))
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    # Call fn, a request of about the given tokens, and return its result
+    def call(self, fn, tokens=0):
+        for attempt in range(self.max_retries + 1):
+            self.limiter.acquire(tokens)
+            self.concurrency.acquire()
+            start = time.monotonic()
+            try:
+                result = fn()
+            except Exception as e:
+                if not is_retryable(e) or attempt == self.max_retries:
+                    raise
+                if getattr(e, "status_code", None) == 429:
+                    self.concurrency.on_rate_limit()
+                error = e
+            else:
+                self.concurrency.on_success(time.monotonic() - start)
+                return result
+            finally:
+                self.concurrency.release()
+
+            # Full jitter, but never sooner than the provider asked for
+            delay = random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+            delay = max(delay, retry_after(error) or 0)
+            logging.warning(
+                f"Request failed ({error}), retry {attempt + 1}/{self.max_retries} in {delay:.1f}s"
+            )
+            telemetry.record_retry()
+            time.sleep(delay)
+
+
+class RateLimitedEndPoint:
+    """
+    Wraps a ChatCompletionEndPoint so that every completion request runs
+    through a shared RequestScheduler. The token estimate of a request is its
+    rendered prompt plus max_tokens, or expected_completion_tokens if unset.
+    """
+
+    def __init__(
+        self,
+        chatbot: ChatCompletionEndPoint,
+        scheduler: RequestScheduler,
+        expected_completion_tokens=500,
+    ):
+        self.chatbot = chatbot
+        self.scheduler = scheduler
+        self.expected_completion_tokens = expected_completion_tokens
+        self._default_model = chatbot._default_model
+
+    def completions(
+        self,
+        message_list: MessageList,
+        substitution_dict: SubstitutionDict = None,
+        model: str = None,
+        **kwargs,
+    ):
+        tokens = kwargs.get("max_tokens") or self.expected_completion_tokens
+        for message in message_list.to_dict(substitution_dict or SubstitutionDict()):
+            for content in message["content"]:
+                tokens += estimate_tokens(content.get("text", ""))
+        return self.scheduler.call(
+            lambda: self.chatbot.completions(
+                message_list, substitution_dict=substitution_dict, model=model, **kwargs
+            ),
+            tokens,
+        )
+
+
+class RateLimitedEmbeddingBackend:
+    """
+    Wraps an embedding backend so that every embeddings request runs through
+    a RequestScheduler. Texts are split into API-sized batches here, and each
+    batch is one scheduled request.
+    """
+
+    def __init__(self, backend, scheduler: RequestScheduler):
+        self.backend = backend
+        self.scheduler = scheduler
+        self.model = backend.model
+        self.cacheable = backend.cacheable
+        self.remote = backend.remote
+
+    def embed(self, texts: list) -> np.ndarray:
+        batches = make_batches(texts)
+        if len(batches) == 1:
+            tokens = sum(estimate_tokens(text) for text in texts)
+            return self.scheduler.call(lambda: self.backend.embed(texts), tokens)
+        parts = []
+        for batch in batches:
+            batch_texts = [texts[i] for i in batch]
+            tokens = sum(estimate_tokens(text) for text in batch_texts)
+            parts.append(
+                self.scheduler.call(
+                    lambda batch_texts=batch_texts: self.backend.embed(batch_texts),
+                    tokens,
+                )
+            )
+        return np.concatenate(parts)
@@ -5,11 +5,17 @@ from OpenAIChatHelper.message import (
     DevSysUserMessage,
     TextContent,
 )
-from embedding import get_embedding
-import numpy as np
-from sklearn.cluster import KMeans
+from embedding import get_embeddings
+from executor import make_context, map_completions, imap_completions
+from journal import Journal
+from clustering import choose_k, cluster_embeddings
+from dedup import deduplicate
+from hazard_index import retrieve_prior_hazards, seed_hazard_list
+from packing import pack_clusters
+from structured import ParseError
+from utils import estimate_tokens
 import logging
-import random
+import telemetry
 
 # Configure basic logging
 logging.basicConfig(
@@ -19,9 +25,43 @@ logging.basicConfig(
 )
 
 
+# Parse a numbered list response into its stripped items
+def parse_ordered_list(response) -> list:
+    res, meta = response
+    content: TextContent = res[0][0]
+    items = [item.strip() for item in content.split_ordered_list()]
+    if not any(items):
+        raise ParseError("Expected a numbered list")
+    return items
+
+
+# Parse a single phrase response
+def parse_text(response) -> str:
+    res, meta = response
+    content: TextContent = res[0][0]
+    if not content.text.strip():
+        raise ParseError("Expected a short phrase")
+    return content.text.strip()
+
+
+# Parse the returned list of stakeholders into name and description
+def parse_stakeholders(response) -> list:
+    stakeholder_list = []
+    for stakeholder in parse_ordered_list(response):
+        if " - " not in stakeholder:
+            raise ParseError(f"Expected 'Name - Description', got {stakeholder!r}")
+        stake_holder_name, stake_holder_description = stakeholder.split(" - ", 1)
+        stakeholder_list.append(
+            {"name": stake_holder_name, "description": stake_holder_description}
+        )
+    return stakeholder_list
+
+
 # Identify stakeholders using chatbot, based on the system description
 def identify_stakeholders(
-    chatbot: ChatCompletionEndPoint, substitution_dict: SubstitutionDict
+    chatbot: ChatCompletionEndPoint,
+    substitution_dict: SubstitutionDict,
+    journal: Journal = None,
 ):
     message_list = MessageList()
 
@@ -59,22 +99,17 @@ def identify_stakeholders(
         )
     )
 
-    # Get chatbot response
-    res, meta = chatbot.completions(
-        message_list, substitution_dict=substitution_dict, temperature=0.0
+    # Get chatbot response and parse it into name and description
+    [stakeholders] = map_completions(
+        chatbot,
+        message_list,
+        [substitution_dict],
+        parse=parse_stakeholders,
+        journal=journal,
+        step="identify_stakeholders",
+        schema="stakeholders",
+        temperature=0.0,
     )
-
-    # Parse returned list of stakeholders into name and description
-    stakeholder_content: TextContent = res[0][0]
-    stakeholders = stakeholder_content.split_ordered_list()
-    stakeholder_list = []
-    for stakeholder in stakeholders:
-        stakeholder = stakeholder.strip()
-        stake_holder_name, stake_holder_description = stakeholder.split(" - ", 1)
-        stakeholder_list.append(
-            {"name": stake_holder_name, "description": stake_holder_description}
-        )
-    stakeholders = stakeholder_list
     return stakeholders
 
 
@@ -83,6 +118,7 @@ def identify_values(
     chatbot: ChatCompletionEndPoint,
     substitution_dict: SubstitutionDict,
     stakeholders: list,
+    journal: Journal = None,
 ):
     message_list = MessageList()
 
@@ -118,16 +154,29 @@ def identify_values(
         )
     )
 
-    # Iterate through each stakeholder to get their associated values/goals
+    # Request the values/goals of every stakeholder concurrently
+    contexts = [
+        make_context(
+            substitution_dict, stakeholder=f"{item['name']} - {item['description']}"
+        )
+        for item in stakeholders
+    ]
+    results = map_completions(
+        chatbot,
+        message_list,
+        contexts,
+        parse=parse_ordered_list,
+        journal=journal,
+        step="identify_values",
+        labels=[item["name"] for item in stakeholders],
+        schema="list",
+        temperature=0.0,
+    )
+
+    # Iterate through each stakeholder to collect their associated values/goals
     for i in range(len(stakeholders)):
         item = stakeholders[i]
-        substitution_dict["stakeholder"] = f"{item['name']} - {item['description']}"
-        res, meta = chatbot.completions(
-            message_list, substitution_dict=substitution_dict, temperature=0.0
-        )
-        values_content: TextContent = res[0][0]
-        value = values_content.split_ordered_list()
-        value = [val.strip() for val in value]
+        value = results[i]
         logging.info(f"Values and Goals for {item['name']}:")
         for val in value:
             logging.info(f"\t- {val}")
@@ -137,10 +186,47 @@ def identify_values(
     return stakeholders
 
 
-# Identify potential losses from values using chatbot
+# Identify potential losses from values using chatbot. With batching, the
+# values of a stakeholder are sent together in token-bounded groups.
 def identify_losses(
-    chatbot: ChatCompletionEndPoint, substitution_dict: SubstitutionDict, values: list
+    chatbot: ChatCompletionEndPoint,
+    substitution_dict: SubstitutionDict,
+    values: list,
+    journal: Journal = None,
+    batching: dict = None,
 ):
+    # Every (stakeholder, value) pair, in the order the losses are collected
+    pairs = [(item, val) for item in values for val in item["values"]]
+    if batching is None:
+        results = request_losses(chatbot, substitution_dict, pairs, journal)
+    else:
+        results = request_batched_losses(
+            chatbot, substitution_dict, pairs, journal, **batching
+        )
+    results = iter(results)
+
+    # Loop through values and collect the loss of each
+    for i in range(len(values)):
+        item = values[i]
+        logging.info(f"Identifying losses for {item['name']}")
+        for val in item["values"]:
+            loss = next(results)
+            logging.info(f"\tLoss for {val} is: {loss}")
+            if "losses" not in item:
+                item["losses"] = []
+            item["losses"].append(loss)
+        logging.info(f"{'*' * 5}")
+        values[i] = item
+    return values
+
+
+# Request the loss of every (stakeholder, value) pair, one request per pair
+def request_losses(
+    chatbot: ChatCompletionEndPoint,
+    substitution_dict: SubstitutionDict,
+    pairs: list,
+    journal: Journal = None,
+) -> list:
     message_list = MessageList()
 
     # Instruction for converting a value into a loss
@@ -172,30 +258,160 @@ def identify_losses(
         )
     )
 
-    # Loop through values and convert each into a potential loss
-    for i in range(len(values)):
-        item = values[i]
-        substitution_dict["stakeholder"] = f"{item['name']} - {item['description']}"
-        logging.info(f"Identifying losses for {item['name']}")
-        for val in item["values"]:
-            substitution_dict["value"] = val
-            res, meta = chatbot.completions(
-                message_list, substitution_dict=substitution_dict, temperature=0.0
+    # Request the loss of every (stakeholder, value) pair concurrently
+    contexts = [
+        make_context(
+            substitution_dict,
+            stakeholder=f"{item['name']} - {item['description']}",
+            value=val,
+        )
+        for item, val in pairs
+    ]
+    return map_completions(
+        chatbot,
+        message_list,
+        contexts,
+        parse=parse_text,
+        journal=journal,
+        step="identify_losses",
+        labels=[item["name"] for item, val in pairs],
+        schema="text",
+        temperature=0.0,
+    )
+
+
+# Split the pairs into groups of values of the same stakeholder, with at most
+# max_items values and max_tokens estimated tokens of values per group.
+# Groups are lists of indices into pairs.
+def group_values(pairs: list, max_items=20, max_tokens=1000) -> list:
+    groups = []
+    group_tokens = 0
+    for i, (item, val) in enumerate(pairs):
+        tokens = estimate_tokens(f"1. {val}\n")
+        if (
+            groups
+            and pairs[groups[-1][0]][0] is item
+            and len(groups[-1]) < max_items
+            and group_tokens + tokens <= max_tokens
+        ):
+            groups[-1].append(i)
+            group_tokens += tokens
+        else:
+            groups.append([i])
+            group_tokens = tokens
+    return groups
+
+
+# Request the losses of the pairs with one request per group of values. A
+# response whose numbered list does not have one loss per value cannot be
+# aligned, so its group is split in halves and retried. Single values are
+# requested with the unbatched prompt.
+def request_batched_losses(
+    chatbot: ChatCompletionEndPoint,
+    substitution_dict: SubstitutionDict,
+    pairs: list,
+    journal: Journal = None,
+    max_items=20,
+    max_tokens=1000,
+) -> list:
+    message_list = MessageList()
+
+    # Instruction for converting a numbered list of values into aligned losses
+    message_list.add_message(
+        DevSysUserMessage(
+            "system",
+            TextContent(
+                "Using the system description and a numbered list of high-level values or goals of the stakeholder, "
+                "reverse each value or goal into a corresponding high-level loss. "
+                "Answer with exactly one loss per value or goal, in the same order and with the same numbers. "
+                "Format your response as follows:\n"
+                "1. A Short phrase describing the loss of value or goal 1\n"
+                "2. A Short phrase describing the loss of value or goal 2\n"
+                "... \n"
+            ),
+        )
+    )
+
+    # User message template
+    message_list.add_message(
+        DevSysUserMessage(
+            "user",
+            TextContent(
+                "System Description:\n"
+                "{system_description}\n\n"
+                "Stakeholder:\n"
+                "{stakeholder}\n\n"
+                "Values or goals:\n"
+                "{value_list}\n\n"
+                "Losses:\n"
+            ),
+        )
+    )
+
+    results = [None] * len(pairs)
+    groups = group_values(pairs, max_items, max_tokens)
+    while groups:
+        singles = [group[0] for group in groups if len(group) == 1]
+        groups = [group for group in groups if len(group) > 1]
+
+        # Request every group concurrently
+        contexts = []
+        for group in groups:
+            item = pairs[group[0]][0]
+            value_list = "\n".join(
+                f"{n}. {pairs[i][1]}" for n, i in enumerate(group, 1)
             )
-            loss_content: TextContent = res[0][0]
-            loss = loss_content.text.strip()
-            logging.info(f"\tLoss for {val} is: {loss}")
-            if "losses" not in item:
-                item["losses"] = []
-            item["losses"].append(loss)
-        logging.info(f"{'*' * 5}")
-        values[i] = item
-    return values
+            contexts.append(
+                make_context(
+                    substitution_dict,
+                    stakeholder=f"{item['name']} - {item['description']}",
+                    value_list=value_list,
+                )
+            )
+        responses = map_completions(
+            chatbot,
+            message_list,
+            contexts,
+            parse=parse_ordered_list,
+            journal=journal,
+            step="identify_losses_batched",
+            labels=[pairs[group[0]][0]["name"] for group in groups],
+            schema="list",
+            temperature=0.0,
+        )
+
+        # Keep aligned responses and split the groups of the others
+        retry = []
+        for group, losses in zip(groups, responses):
+            if len(losses) == len(group):
+                for i, loss in zip(group, losses):
+                    results[i] = loss
+            else:
+                logging.warning(
+                    f"Expected {len(group)} losses for {pairs[group[0]][0]['name']}, "
+                    f"got {len(losses)}; retrying the group in halves"
+                )
+                telemetry.record_parse_failure("identify_losses_batched")
+                half = len(group) // 2
+                retry.extend([group[:half], group[half:]])
+
+        single_losses = request_losses(
+            chatbot, substitution_dict, [pairs[i] for i in singles], journal
+        )
+        for i, loss in zip(singles, single_losses):
+            results[i] = loss
+        groups = retry
+    return results
 
 
 # Identify hazards that could lead to each loss
 def identify_hazards(
-    chatbot: ChatCompletionEndPoint, substitution_dict: SubstitutionDict, losses: list
+    chatbot: ChatCompletionEndPoint,
+    substitution_dict: SubstitutionDict,
+    losses: list,
+    journal: Journal = None,
+    retrieval: dict = None,
+    consolidator=None,
 ):
     message_list = MessageList()
 
@@ -234,26 +450,63 @@ def identify_hazards(
         )
     )
 
-    # Loop over each loss and collect hazards
+    # With retrieval, reuse the hazards of similar losses of prior runs
+    pairs = [(item, loss) for item in losses for loss in item["losses"]]
+    prior = [None] * len(pairs)
+    if retrieval is not None:
+        prior = retrieve_prior_hazards(
+            [loss for item, loss in pairs],
+            [item["name"] for item, loss in pairs],
+            **retrieval,
+        )
+        logging.info(
+            f"Reusing prior hazards for {sum(p is not None for p in prior)} of {len(pairs)} losses"
+        )
+    pending = [i for i in range(len(pairs)) if prior[i] is None]
+
+    # Request the hazards of every other (stakeholder, loss) pair concurrently
+    contexts = [
+        make_context(
+            substitution_dict,
+            stakeholder=f"{pairs[i][0]['name']} - {pairs[i][0]['description']}",
+            loss=pairs[i][1],
+        )
+        for i in pending
+    ]
+    generated = imap_completions(
+        chatbot,
+        message_list,
+        contexts,
+        parse=parse_ordered_list,
+        journal=journal,
+        step="identify_hazards",
+        labels=[pairs[i][0]["name"] for i in pending],
+        schema="list",
+        temperature=0.0,
+    )
+    results = (
+        prior[i] if prior[i] is not None else next(generated) for i in range(len(pairs))
+    )
+
+    # Loop over each loss and collect hazards as they arrive. With an online
+    # consolidator, every hazard list is handed over to be clustered while
+    # the remaining losses are still being requested.
     for i in range(len(losses)):
         item = losses[i]
-        substitution_dict["stakeholder"] = f"{item['name']} - {item['description']}"
         logging.info(f"Identifying hazards for {item['name']}")
         item["hazards"] = {}
+        if consolidator is not None:
+            consolidator.start(item["name"], len(item["losses"]))
         for j in range(len(item["losses"])):
             loss = item["losses"][j]
-            substitution_dict["loss"] = loss
-            res, meta = chatbot.completions(
-                message_list, substitution_dict=substitution_dict, temperature=0.0
-            )
-            hazard_content: TextContent = res[0][0]
-            hazard = hazard_content.split_ordered_list()
-            hazard = [h.strip() for h in hazard]
+            hazard = next(results)
             logging.info(f"Hazards for {loss}:")
             for h in hazard:
                 logging.info(f"\t- {h}")
             logging.info(f"{'*' * 5}")
             item["hazards"][loss] = hazard
+            if consolidator is not None:
+                consolidator.add(item["name"], hazard)
         losses[i] = item
     return losses
 
@@ -263,68 +516,105 @@ def consolidate_hazards(
     chatbot: ChatCompletionEndPoint,
     substitution_dict: SubstitutionDict,
     hazards_comprehensive: list,
+    journal: Journal = None,
+    clustering: dict = None,
+    dedup: dict = None,
+    dedup_map: dict = None,
+    packing: dict = None,
+    retrieval: dict = None,
 ):
+    # Cluster the hazards of every stakeholder separately, in a single pass so
+    # that the stakeholders can be streamed from the previous step's output
     hazard_num = 0
-    for item in hazards_comprehensive:
-        for loss, hazards in item["hazards"].items():
-            hazard_num += len(hazards)
-    logging.info(f"Total number of hazards: {hazard_num}")
-
-    hazard_list = []
+    clusters = []
     for item in hazards_comprehensive:
         hazard_list_per_item = []
         for loss, hazards in item["hazards"].items():
             hazard_list_per_item.extend(hazards)
-        hazard_list_per_item = consolidate_hazard_list(
-            chatbot, substitution_dict, hazard_list_per_item, n_clusters=20
+        hazard_num += len(hazard_list_per_item)
+        if retrieval is not None:
+            hazard_list_per_item = seed_hazard_list(
+                hazard_list_per_item, dedup_map, **retrieval
+            )
+        clusters.extend(
+            cluster_hazard_list(
+                hazard_list_per_item,
+                n_clusters=20,
+                dedup=dedup,
+                dedup_map=dedup_map,
+                packing=packing,
+                **(clustering or {}),
+            )
         )
-        hazard_list.extend(hazard_list_per_item)
+
+    logging.info(f"Total number of hazards: {hazard_num}")
+
+    # Merge the clusters of all stakeholders concurrently
+    hazard_list = []
+    for merged in merge_hazard_clusters(
+        chatbot, substitution_dict, clusters, journal=journal
+    ):
+        hazard_list.extend(merged)
     logging.info(f"Total number of consolidated hazards: {len(hazard_list)}")
     return hazard_list
 
 
-# Break down hazard list into segments, consolidate each segment
-def divide_and_consolidate(
-    chatbot: ChatCompletionEndPoint,
-    substitution_dict: SubstitutionDict,
+# Group similar hazards into clusters using embeddings. With a
+# target_cluster_size, the number of clusters is chosen from the list length
+# instead of n_clusters. With dedup, exact and near duplicates are removed
+# first and recorded in dedup_map. With packing, clusters are reshaped so that
+# every merge prompt falls in a token window.
+def cluster_hazard_list(
     hazard_list: list,
     n_clusters=20,
-    segment_size=200,
-):
-    random.shuffle(hazard_list)  # Randomize to avoid bias in ordering
-    res = []
-    for i in range(0, len(hazard_list), segment_size):
-        segment = hazard_list[i : i + segment_size]
-        segment = consolidate_hazard_list(
-            chatbot, substitution_dict, segment, n_clusters=n_clusters
+    method="kmeans",
+    target_cluster_size=None,
+    dedup: dict = None,
+    dedup_map: dict = None,
+    packing: dict = None,
+) -> list:
+    if not hazard_list:
+        return []
+
+    embeddings = None
+    if dedup is not None:
+        logging.info("Removing duplicate hazards...")
+        hazard_list, embeddings, absorbed = deduplicate(
+            hazard_list, get_embeddings, **dedup
         )
-        res.extend(segment)
-    return res
+        if dedup_map is not None:
+            for survivor, hazards in absorbed.items():
+                dedup_map.setdefault(survivor, []).extend(hazards)
 
-
-# Core function to group similar hazards using embeddings and clustering
-def consolidate_hazard_list(
-    chatbot: ChatCompletionEndPoint,
-    substitution_dict: SubstitutionDict,
-    hazard_list: list,
-    n_clusters=20,
-):
+    if target_cluster_size is not None:
+        n_clusters = None
+    n_clusters = choose_k(len(hazard_list), n_clusters, target_cluster_size)
     if n_clusters != 1:
-        logging.info("Getting embeddings for hazards...")
-        embeddings = [get_embedding(hazard) for hazard in hazard_list]
+        if embeddings is None:
+            logging.info("Getting embeddings for hazards...")
+            embeddings = get_embeddings(hazard_list)
 
-        logging.info("Performing clustering on embeddings...")
-        embeddings = np.array(embeddings)
-        kmeans = KMeans(n_clusters=n_clusters, random_state=42).fit(embeddings)
-        labels = kmeans.labels_
+        logging.info(f"Performing {method} clustering into {n_clusters} clusters...")
+        labels = cluster_embeddings(embeddings, n_clusters=n_clusters, method=method)
         hazard_clusters = {}
         for i, label in enumerate(labels):
             label = str(label)
             if label not in hazard_clusters:
                 hazard_clusters[label] = []
-            hazard_clusters[label].append(hazard_list[i])
+            hazard_clusters[label].append(i)
     else:
-        hazard_clusters = {"0": hazard_list}
+        hazard_clusters = {"0": list(range(len(hazard_list)))}
+
+    # Split oversized clusters and combine small ones into shared prompts
+    if packing is not None:
+        packed = pack_clusters(
+            list(hazard_clusters.values()), hazard_list, embeddings, **packing
+        )
+        hazard_clusters = {str(i): group for i, group in enumerate(packed)}
+    hazard_clusters = {
+        cluster: [hazard_list[i] for i in group]
+        for cluster, group in hazard_clusters.items()
+    }
 
     # Log clusters before consolidation
     for cluster, hazards in hazard_clusters.items():
@@ -333,6 +623,16 @@ def consolidate_hazard_list(
             logging.info(f"\t- {hazard}")
         logging.info(f"{'*' * 5}")
 
+    return list(hazard_clusters.values())
+
+
+# Merge similar hazards within each cluster, one concurrent request per cluster
+def merge_hazard_clusters(
+    chatbot: ChatCompletionEndPoint,
+    substitution_dict: SubstitutionDict,
+    hazard_clusters: list,
+    journal: Journal = None,
+) -> list:
     # Prepare messages for merging similar hazard statements
     message_list = MessageList()
     message_list.add_message(
@@ -363,19 +663,30 @@ def consolidate_hazard_list(
         )
     )
 
-    res_list = []
-    for cluster, hazards in hazard_clusters.items():
-        hazards = [f"- {hazard}" for hazard in hazards]
-        substitution_dict["hazard_list"] = "\n".join(hazards)
-        res, meta = chatbot.completions(
-            message_list, substitution_dict=substitution_dict, temperature=0.0
+    contexts = [
+        make_context(
+            substitution_dict,
+            hazard_list="\n".join(f"- {hazard}" for hazard in hazards),
         )
-        consolidated_hazards: TextContent = res[0][0]
-        consolidated_hazards = consolidated_hazards.split_ordered_list()
-        consolidated_hazards = [h.strip() for h in consolidated_hazards]
+        for hazards in hazard_clusters
+    ]
+    results = map_completions(
+        chatbot,
+        message_list,
+        contexts,
+        parse=parse_ordered_list,
+        journal=journal,
+        step="merge_hazard_clusters",
+        labels=[f"cluster {i}" for i in range(len(hazard_clusters))],
+        schema="list",
+        temperature=0.0,
+    )
+
+    merged_clusters = []
+    for cluster, consolidated_hazards in enumerate(results):
         logging.info(f"Consolidated Hazards for Cluster {cluster}:")
         for h in consolidated_hazards:
             logging.info(f"\t- {h}")
         logging.info(f"{'*' * 5}")
-        res_list.extend(consolidated_hazards)
-    return res_list
+        merged_clusters.append(consolidated_hazards)
+    return merged_clusters
@@ -0,0 +1,176 @@
+import json
+from OpenAIChatHelper.message import (
+    MessageList,
+    DevSysUserMessage,
+    AssistantMessage,
+    TextContent,
+)
+
+# Response formats selectable in config.yml
+MODES = ["json_schema", "json_object"]
+
+# JSON schemas of structured responses, by kind. The result of a response is
+# the value of the only property of its object.
+SCHEMAS = {
+    "list": {
+        "type": "object",
+        "properties": {"items": {"type": "array", "items": {"type": "string"}}},
+        "required": ["items"],
+        "additionalProperties": False,
+    },
+    "text": {
+        "type": "object",
+        "properties": {"text": {"type": "string"}},
+        "required": ["text"],
+        "additionalProperties": False,
+    },
+    "stakeholders": {
+        "type": "object",
+        "properties": {
+            "stakeholders": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "name": {"type": "string"},
+                        "description": {"type": "string"},
+                    },
+                    "required": ["name", "description"],
+                    "additionalProperties": False,
+                },
+            }
+        },
+        "required": ["stakeholders"],
+        "additionalProperties": False,
+    },
+}
+
+
+class ParseError(ValueError):
+    """
+    Raised when a response does not have the format its step asked for.
+    """
+
+
+# Escape braces, so that rendering the text as a template leaves it unchanged
+def escape_braces(text: str) -> str:
+    return text.replace("{", "{{").replace("}", "}}")
+
+
+# Text of the first choice of a (res, meta) response
+def response_text(response) -> str:
+    res, meta = response
+    if not res or not len(res[0]):
+        raise ParseError("Empty response")
+    return res[0][0].text
+
+
+# Check a value against the subset of JSON schema used in SCHEMAS. Strings
+# and arrays must not be empty either.
+def validate(value, schema: dict, path="response"):
+    if schema["type"] == "object":
+        if not isinstance(value, dict):
+            raise ParseError(f"{path} must be an object")
+        for name in schema["required"]:
+            if name not in value:
+                raise ParseError(f"{path} is missing {name}")
+        for name, prop in schema["properties"].items():
+            validate(value[name], prop, f"{path}.{name}")
+    elif schema["type"] == "array":
+        if not isinstance(value, list) or not value:
+            raise ParseError(f"{path} must be a non-empty array")
+        for i, item in enumerate(value):
+            validate(item, schema["items"], f"{path}[{i}]")
+    elif schema["type"] == "string":
+        if not isinstance(value, str) or not value.strip():
+            raise ParseError(f"{path} must be a non-empty string")
+
+
+# Parse and validate a structured response of the given kind
+def parse_json(response, kind: str):
+    try:
+        data = json.loads(response_text(response))
+    except json.JSONDecodeError as e:
+        raise ParseError(f"Invalid JSON: {e}") from e
+    schema = SCHEMAS[kind]
+    validate(data, schema)
+    return data[schema["required"][0]]
+
+
+# Parse a structured list response into its stripped items
+def parse_json_list(response) -> list:
+    return [item.strip() for item in parse_json(response, "list")]
+
+
+# Parse a structured single phrase response
+def parse_json_text(response) -> str:
+    return parse_json(response, "text").strip()
+
+
+# Parse a structured list of stakeholders into name and description
+def parse_json_stakeholders(response) -> list:
+    return [
+        {"name": item["name"].strip(), "description": item["description"].strip()}
+        for item in parse_json(response, "stakeholders")
+    ]
+
+
+# Parse functions of the structured responses, by kind
+PARSERS = {
+    "list": parse_json_list,
+    "text": parse_json_text,
+    "stakeholders": parse_json_stakeholders,
+}
+
+
+# Turn a request for a text response into a request for a JSON response of
+# the given kind. The schema is added after the system message, overriding its
+# format instructions. Returns the message list, parameters and parse function.
+def structure_request(message_list: MessageList, params: dict, kind: str, mode: str):
+    schema = SCHEMAS[kind]
+    instruction = (
+        "Instead of the format above, respond only with a JSON object "
+        f"matching this JSON schema:\n{json.dumps(schema)}"
+    )
+    structured = MessageList()
+    structured.add_message(message_list[0])
+    structured.add_message(
+        DevSysUserMessage("system", TextContent(escape_braces(instruction)))
+    )
+    for i in range(1, len(message_list)):
+        structured.add_message(message_list[i])
+
+    if mode == "json_schema":
+        response_format = {
+            "type": "json_schema",
+            "json_schema": {"name": kind, "schema": schema, "strict": True},
+        }
+    else:
+        response_format = {"type": "json_object"}
+    return structured, {**params, "response_format": response_format}, PARSERS[kind]
+
+
+# The request of message_list followed by a response that failed to parse and
+# its error, asking for the same answer in the requested format
+def retry_request(message_list: MessageList, response, error) -> MessageList:
+    retry = MessageList()
+    for i in range(len(message_list)):
+        retry.add_message(message_list[i])
+    try:
+        retry.add_message(
+            AssistantMessage(TextContent(escape_braces(response_text(response))))
+        )
+    except ParseError:
+        pass  # Nothing to show of an empty response
+    retry.add_message(
+        DevSysUserMessage(
+            "user",
+            TextContent(
+                escape_braces(
+                    f"Your response could not be read: {error}. "
+                    "Respond again with the same content, exactly in the requested format."
+                )
+            ),
+        )
+    )
+    return retry
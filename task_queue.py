@@ -0,0 +1,281 @@
+import os
+import json
+import time
+import logging
+import sqlite3
+import importlib
+import threading
+from OpenAIChatHelper.message import MessageList, DevSysUserMessage, TextContent
+from batch_api import BATCH_STEPS
+from journal import unit_key
+from structured import escape_braces
+
+# States of a task
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+
+# Number of task ids looked up in one query
+LOOKUP_CHUNK_SIZE = 500
+
+
+class TaskQueue:
+    """
+    Durable queue of units of work in a SQLite database, shared by the
+    coordinator and worker processes on one or several hosts.
+
+    Workers lease tasks for lease_seconds and ack them with their result. A
+    task whose lease expires without an ack is leased again, up to
+    max_attempts times, so every task runs at least once. Tasks are keyed by
+    their unit key: putting a task again is a no-op, and a restarted
+    coordinator gets the results its workers already finished. The database
+    must be on storage with working file locks, and it uses the rollback
+    journal since WAL mode does not work across hosts.
+    """
+
+    def __init__(self, path=".cache/tasks.sqlite", lease_seconds=300, max_attempts=5):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._db = sqlite3.connect(
+            path, timeout=60, isolation_level=None, check_same_thread=False
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS tasks ("
+            "id TEXT PRIMARY KEY, step TEXT NOT NULL, payload TEXT NOT NULL, "
+            "state TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, "
+            "worker TEXT, lease_expires REAL, result TEXT, error TEXT, "
+            "created REAL NOT NULL, updated REAL NOT NULL)"
+        )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS tasks_state ON tasks (state, created)"
+        )
+
+    # Run fn(db) in one write transaction, taking the database lock up front
+    def _transaction(self, fn):
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn(self._db)
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+            return result
+
+    # Add (id, step, payload) tasks. Tasks that failed before are retried.
+    def put(self, tasks: list):
+        now = time.time()
+
+        def put(db):
+            db.executemany(
+                "INSERT INTO tasks (id, step, payload, state, created, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (id) DO UPDATE SET "
+                "state = excluded.state, attempts = 0, error = NULL, "
+                "updated = excluded.updated WHERE tasks.state = 'failed'",
+                [
+                    (task_id, step, json.dumps(payload), PENDING, now, now)
+                    for task_id, step, payload in tasks
+                ],
+            )
+
+        self._transaction(put)
+
+    # Lease up to n tasks for the worker, oldest first. Returns them as
+    # (id, step, payload) tuples.
+    def lease(self, worker: str, n=1) -> list:
+        now = time.time()
+
+        def lease(db):
+            # Expired leases of tasks out of attempts will not be retried
+            db.execute(
+                "UPDATE tasks SET state = ?, error = ?, updated = ? "
+                "WHERE state = ? AND lease_expires < ? AND attempts >= ?",
+                (
+                    FAILED,
+                    f"Lease expired after {self.max_attempts} attempts",
+                    now,
+                    LEASED,
+                    now,
+                    self.max_attempts,
+                ),
+            )
+            rows = db.execute(
+                "SELECT id, step, payload FROM tasks "
+                "WHERE state = ? OR (state = ? AND lease_expires < ?) "
+                "ORDER BY created LIMIT ?",
+                (PENDING, LEASED, now, n),
+            ).fetchall()
+            db.executemany(
+                "UPDATE tasks SET state = ?, worker = ?, lease_expires = ?, "
+                "attempts = attempts + 1, updated = ? WHERE id = ?",
+                [
+                    (LEASED, worker, now + self.lease_seconds, now, row[0])
+                    for row in rows
+                ],
+            )
+            return [(task_id, step, json.loads(p)) for task_id, step, p in rows]
+
+        return self._transaction(lease)
+
+    # Extend the leases the worker holds on tasks still in progress
+    def extend(self, worker: str, ids: list):
+        now = time.time()
+        self._transaction(
+            lambda db: db.executemany(
+                "UPDATE tasks SET lease_expires = ?, updated = ? "
+                "WHERE id = ? AND worker = ? AND state = ?",
+                [
+                    (now + self.lease_seconds, now, task_id, worker, LEASED)
+                    for task_id in ids
+                ],
+            )
+        )
+
+    # Store the result of a task. A late ack of a task that was leased again
+    # is still accepted, as long as no other worker finished it first.
+    def ack(self, worker: str, task_id: str, result):
+        now = time.time()
+        self._transaction(
+            lambda db: db.execute(
+                "UPDATE tasks SET state = ?, worker = ?, result = ?, error = NULL, "
+                "updated = ? WHERE id = ? AND state != ?",
+                (DONE, worker, json.dumps(result), now, task_id, DONE),
+            )
+        )
+
+    # Give a task back after an error, to be retried unless out of attempts
+    def fail(self, worker: str, task_id: str, error: str):
+        now = time.time()
+        self._transaction(
+            lambda db: db.execute(
+                "UPDATE tasks SET state = CASE WHEN attempts >= ? THEN ? ELSE ? END, "
+                "error = ?, updated = ? WHERE id = ? AND worker = ? AND state = ?",
+                (
+                    self.max_attempts,
+                    FAILED,
+                    PENDING,
+                    error,
+                    now,
+                    task_id,
+                    worker,
+                    LEASED,
+                ),
+            )
+        )
+
+    # State, result and error of the given tasks, by id
+    def lookup(self, ids: list) -> dict:
+        tasks = {}
+        ids = list(ids)
+        with self._lock:
+            for start in range(0, len(ids), LOOKUP_CHUNK_SIZE):
+                chunk = ids[start : start + LOOKUP_CHUNK_SIZE]
+                rows = self._db.execute(
+                    "SELECT id, state, result, error FROM tasks "
+                    f"WHERE id IN ({', '.join('?' * len(chunk))})",
+                    chunk,
+                ).fetchall()
+                for task_id, state, result, error in rows:
+                    tasks[task_id] = (state, result, error)
+        return tasks
+
+    # Number of tasks in every state
+    def counts(self) -> dict:
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT state, COUNT(*) FROM tasks GROUP BY state"
+            ).fetchall()
+        return dict(rows)
+
+
+# Name under which a module-level function is sent to the workers
+def function_name(fn) -> str:
+    return f"{fn.__module__}:{fn.__qualname__}"
+
+
+# Import the module-level function of a name from function_name
+def load_function(name: str):
+    module, qualname = name.split(":")
+    return getattr(importlib.import_module(module), qualname)
+
+
+# Rebuild a message list from its rendered messages, with braces escaped
+def load_message_list(messages: list) -> MessageList:
+    message_list = MessageList()
+    for message in messages:
+        contents = [
+            TextContent(escape_braces(content["text"]))
+            for content in message["content"]
+        ]
+        message_list.add_message(DevSysUserMessage(message["role"], contents))
+    return message_list
+
+
+class TaskRunner:
+    """
+    Hands the units of fan-out steps to worker processes through a
+    TaskQueue, and waits for their parsed results. A task carries the
+    rendered request and the name of its parse function, so workers parse the
+    responses too. Parse functions must be module-level functions.
+    """
+
+    def __init__(self, queue: TaskQueue, steps=None, poll_interval=0.5):
+        self.queue = queue
+        self.steps = BATCH_STEPS if steps is None else steps
+        self.poll_interval = poll_interval
+
+    # Whether the units of a step with the parse function can be distributed
+    def handles(self, step: str, parse) -> bool:
+        return (
+            step in self.steps and parse is not None and "<" not in function_name(parse)
+        )
+
+    # Put a task for every context and return the parsed results in input order
+    def run(self, step, model, message_list, contexts: list, params: dict, parse):
+        ids = []
+        tasks = {}
+        for context in contexts:
+            messages = message_list.to_dict(context)
+            task_id = unit_key(step, model, messages, params)
+            ids.append(task_id)
+            tasks[task_id] = {
+                "model": model,
+                "messages": messages,
+                "params": params,
+                "parse": function_name(parse),
+            }
+        self.queue.put([(task_id, step, tasks[task_id]) for task_id in tasks])
+        logging.info(f"Queued {len(tasks)} {step} tasks for the workers")
+
+        last_log = time.monotonic()
+        while True:
+            found = self.queue.lookup(tasks)
+            failed = [i for i, (state, r, e) in found.items() if state == FAILED]
+            if failed:
+                raise RuntimeError(
+                    f"Task {failed[0]} of {step} failed: {found[failed[0]][2]}"
+                )
+            done = sum(state == DONE for state, r, e in found.values())
+            if done == len(tasks):
+                break
+            if time.monotonic() - last_log >= 30:
+                last_log = time.monotonic()
+                logging.info(f"Waiting for {step}: {done}/{len(tasks)} tasks done")
+            time.sleep(self.poll_interval)
+        return [json.loads(found[task_id][1]) for task_id in ids]
+
+
+# Create the task runner configured in config.yml
+def make_task_runner(
+    path=".cache/tasks.sqlite",
+    lease_seconds=300,
+    max_attempts=5,
+    steps=None,
+    poll_interval=0.5,
+):
+    queue = TaskQueue(path, lease_seconds=lease_seconds, max_attempts=max_attempts)
+    return TaskRunner(queue, steps=steps, poll_interval=poll_interval)
@@ -0,0 +1,376 @@
+import os
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+import numpy as np
+
+# Upper bounds of the request latency histogram buckets, in seconds
+LATENCY_BUCKETS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float("inf")]
+
+# Prefix of all exported Prometheus metrics
+METRIC_PREFIX = "hazard_finder"
+
+# Recorder of the running analysis and the step it is in. Context variables
+# follow the work into the fan-out threads, so concurrent analyses in one
+# process each record into their own Telemetry.
+_recorder = ContextVar("telemetry_recorder", default=None)
+_step = ContextVar("telemetry_step", default=None)
+_request = ContextVar("telemetry_request", default=None)
+
+
+class StepStats:
+    """
+    Counters of one step: completion requests with their latencies and
+    tokens, embedding lookups, and the same request counters per label
+    (stakeholder or cluster).
+    """
+
+    def __init__(self):
+        self.wall_time = 0.0
+        self.requests = 0
+        self.cached_requests = 0
+        self.errors = 0
+        self.retries = 0
+        self.parse_failures = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.latencies = []
+        self.expected = 0
+        self.started = None
+        self.embedding_texts = 0
+        self.embedding_cache_hits = 0
+        self.embedded_texts = 0
+        self.embedding_time = 0.0
+        self.labels = {}
+
+    def histogram(self) -> list:
+        counts = np.searchsorted(
+            np.sort(self.latencies), LATENCY_BUCKETS[:-1], side="right"
+        )
+        return [int(c) for c in counts] + [len(self.latencies)]
+
+    def to_dict(self) -> dict:
+        latencies = np.asarray(self.latencies)
+        return {
+            "wall_time": self.wall_time,
+            "requests": self.requests,
+            "cached_requests": self.cached_requests,
+            "errors": self.errors,
+            "retries": self.retries,
+            "parse_failures": self.parse_failures,
+            "parse_failure_rate": (
+                self.parse_failures / self.requests if self.requests else 0.0
+            ),
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "latency": {
+                "count": len(latencies),
+                "sum": float(latencies.sum()),
+                "p50": float(np.percentile(latencies, 50)) if len(latencies) else None,
+                "p95": float(np.percentile(latencies, 95)) if len(latencies) else None,
+                "max": float(latencies.max()) if len(latencies) else None,
+                "buckets": dict(zip(map(str, LATENCY_BUCKETS), self.histogram())),
+            },
+            "embeddings": {
+                "texts": self.embedding_texts,
+                "cache_hits": self.embedding_cache_hits,
+                "embedded": self.embedded_texts,
+                "time": self.embedding_time,
+            },
+            "labels": self.labels,
+        }
+
+
+class Telemetry:
+    """
+    Collects per-step metrics of one analysis run. Completion requests are
+    recorded by the fan-out helpers and embedding lookups by get_embeddings,
+    under the step set with telemetry.step. With a progress_interval, the
+    progress and ETA of the running step are logged at most that often.
+    """
+
+    def __init__(self, progress_interval=None):
+        self.progress_interval = progress_interval
+        self.steps = {}
+        self._started = time.time()
+        self._last_progress = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _stats(self, step) -> StepStats:
+        if step not in self.steps:
+            self.steps[step] = StepStats()
+        return self.steps[step]
+
+    def add_wall_time(self, step, seconds):
+        with self._lock:
+            self._stats(step).wall_time += seconds
+
+    def expect(self, step, n):
+        with self._lock:
+            stats = self._stats(step)
+            stats.expected += n
+            if stats.started is None:
+                stats.started = time.monotonic()
+
+    def record_request(
+        self, step, label, latency, prompt_tokens, completion_tokens, cached, error
+    ):
+        with self._lock:
+            stats = self._stats(step)
+            stats.requests += 1
+            stats.cached_requests += cached
+            stats.errors += error
+            stats.prompt_tokens += prompt_tokens
+            stats.completion_tokens += completion_tokens
+            stats.latencies.append(latency)
+            if label is not None:
+                counters = stats.labels.setdefault(
+                    str(label),
+                    {
+                        "requests": 0,
+                        "prompt_tokens": 0,
+                        "completion_tokens": 0,
+                        "latency_sum": 0.0,
+                    },
+                )
+                counters["requests"] += 1
+                counters["prompt_tokens"] += prompt_tokens
+                counters["completion_tokens"] += completion_tokens
+                counters["latency_sum"] += latency
+        self.log_progress(step)
+
+    def record_retry(self, step):
+        with self._lock:
+            self._stats(step).retries += 1
+
+    def record_parse_failure(self, step):
+        with self._lock:
+            self._stats(step).parse_failures += 1
+
+    def record_embeddings(self, step, texts, cache_hits, embedded, seconds):
+        with self._lock:
+            stats = self._stats(step)
+            stats.embedding_texts += texts
+            stats.embedding_cache_hits += cache_hits
+            stats.embedded_texts += embedded
+            stats.embedding_time += seconds
+
+    # Log the progress of a step and its estimated time to completion, from
+    # the request rate since its first fan-out
+    def log_progress(self, step):
+        if self.progress_interval is None:
+            return
+        with self._lock:
+            now = time.monotonic()
+            if now - self._last_progress < self.progress_interval:
+                return
+            self._last_progress = now
+            stats = self.steps[step]
+            done, expected = stats.requests, max(stats.expected, stats.requests)
+            elapsed = now - (stats.started or now)
+        message = f"Progress {step}: {done}/{expected} requests"
+        if 0 < done < expected and elapsed > 0:
+            message += f", {done / elapsed:.1f}/s, ETA {(expected - done) * elapsed / done:.0f}s"
+        logging.info(message)
+
+    def report(self) -> dict:
+        with self._lock:
+            steps = {step: stats.to_dict() for step, stats in self.steps.items()}
+        totals = {
+            key: sum(step[key] for step in steps.values())
+            for key in [
+                "requests",
+                "cached_requests",
+                "errors",
+                "retries",
+                "parse_failures",
+                "prompt_tokens",
+                "completion_tokens",
+            ]
+        }
+        return {
+            "started": self._started,
+            "wall_time": time.time() - self._started,
+            "totals": totals,
+            "steps": steps,
+        }
+
+    # Write the run report as JSON
+    def save_report(self, path):
+        with open(path, "w") as file:
+            json.dump(self.report(), file, indent=4)
+
+    # Write the metrics in the Prometheus text format. The file is replaced
+    # atomically, as the node exporter textfile collector expects.
+    def save_prometheus(self, path):
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            name = f"{METRIC_PREFIX}_{name}"
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                labels = ",".join(f'{k}="{v}"' for k, v in labels.items())
+                lines.append(f"{name}{{{labels}}} {value}")
+
+        with self._lock:
+            steps = dict(self.steps)
+            counters = [
+                ("requests_total", "requests", "Completion requests."),
+                ("cached_requests_total", "cached_requests", "Requests served from the completion cache."),
+                ("request_errors_total", "errors", "Failed completion requests."),
+                ("request_retries_total", "retries", "Retried API requests."),
+                ("parse_failures_total", "parse_failures", "Responses that failed to parse."),
+                ("prompt_tokens_total", "prompt_tokens", "Prompt tokens."),
+                ("completion_tokens_total", "completion_tokens", "Completion tokens."),
+                ("embedding_texts_total", "embedding_texts", "Texts looked up for embeddings."),
+                ("embedding_cache_hits_total", "embedding_cache_hits", "Embeddings served from the cache."),
+                ("embedded_texts_total", "embedded_texts", "Texts sent to the embedding backend."),
+            ]  # fmt: skip
+            for name, attribute, help_text in counters:
+                metric(
+                    name,
+                    "counter",
+                    help_text,
+                    [({"step": s}, getattr(st, attribute)) for s, st in steps.items()],
+                )
+            metric(
+                "step_duration_seconds",
+                "gauge",
+                "Time spent in the step.",
+                [({"step": s}, st.wall_time) for s, st in steps.items()],
+            )
+
+            name = f"{METRIC_PREFIX}_request_latency_seconds"
+            lines.append(f"# HELP {name} Completion request latency.")
+            lines.append(f"# TYPE {name} histogram")
+            for step, stats in steps.items():
+                for bound, count in zip(LATENCY_BUCKETS, stats.histogram()):
+                    le = "+Inf" if bound == float("inf") else bound
+                    lines.append(f'{name}_bucket{{step="{step}",le="{le}"}} {count}')
+                lines.append(f'{name}_sum{{step="{step}"}} {sum(stats.latencies)}')
+                lines.append(f'{name}_count{{step="{step}"}} {len(stats.latencies)}')
+
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "w") as file:
+            file.write("\n".join(lines) + "\n")
+        os.replace(temp_path, path)
+
+
+# Record into recorder in the current context, and the threads it fans out to
+def set_recorder(recorder: Telemetry):
+    _recorder.set(recorder)
+
+
+# The recorder of the current context, or None
+def recorder() -> Telemetry:
+    return _recorder.get()
+
+
+# Attribute the metrics recorded inside the block to the named step. Without
+# timed, the block does not add to the wall time of the step, for work that
+# overlaps with a block of the step that is already timed.
+@contextmanager
+def step(name, timed=True):
+    token = _step.set(name)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _step.reset(token)
+        recorder = _recorder.get()
+        if recorder is not None and timed:
+            recorder.add_wall_time(name, time.perf_counter() - start)
+
+
+# Add seconds to the wall time of the named step, for steps timed outside of
+# a telemetry.step block
+def add_wall_time(name, seconds):
+    recorder = _recorder.get()
+    if recorder is not None:
+        recorder.add_wall_time(name, seconds)
+
+
+# Announce n requests of a fan-out, for the progress estimate
+def expect_requests(step, n):
+    recorder = _recorder.get()
+    if recorder is not None:
+        recorder.expect(_step.get() or step, n)
+
+
+# Time one completion request made inside the block. The block stores the
+# (res, meta) response in request["response"], to read the token usage.
+@contextmanager
+def track_request(step, label=None):
+    request = {"response": None, "cached": False}
+    token = _request.set(request)
+    start = time.perf_counter()
+    error = False
+    try:
+        yield request
+    except Exception:
+        error = True
+        raise
+    finally:
+        latency = time.perf_counter() - start
+        _request.reset(token)
+        record_request(
+            step, label, latency, request["response"], request["cached"], error
+        )
+
+
+# Record a completion request that took latency seconds, such as a request
+# of a batch, with its (res, meta) response unless it failed
+def record_request(step, label, latency, response, cached=False, error=False):
+    recorder = _recorder.get()
+    if recorder is not None:
+        prompt_tokens = completion_tokens = 0
+        # Only tokens of requests sent to the API are counted
+        if response is not None and not cached:
+            usage = getattr(response[1], "usage", None)
+            if usage is not None:
+                prompt_tokens = usage.prompt_tokens
+                completion_tokens = usage.completion_tokens
+        recorder.record_request(
+            _step.get() or step,
+            label,
+            latency,
+            prompt_tokens,
+            completion_tokens,
+            cached,
+            error,
+        )
+
+
+# Mark the request being tracked as served from the completion cache
+def mark_cached():
+    request = _request.get()
+    if request is not None:
+        request["cached"] = True
+
+
+# Record a retried request of the current step
+def record_retry():
+    recorder = _recorder.get()
+    if recorder is not None:
+        recorder.record_retry(_step.get() or "requests")
+
+
+# Record a response of the current step that failed to parse
+def record_parse_failure(step=None):
+    recorder = _recorder.get()
+    if recorder is not None:
+        recorder.record_parse_failure(_step.get() or step or "requests")
+
+
+# Record an embedding lookup of texts, of which cache_hits were cached and
+# embedded were sent to the backend in the given time
+def record_embeddings(texts, cache_hits, embedded, seconds):
+    recorder = _recorder.get()
+    if recorder is not None:
+        recorder.record_embeddings(
+            _step.get() or "embeddings", texts, cache_hits, embedded, seconds
+        )
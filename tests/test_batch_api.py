@@ -0,0 +1,136 @@
+import os
+import pytest
+from OpenAIChatHelper.message import (
+    SubstitutionDict,
+    MessageList,
+    DevSysUserMessage,
+    TextContent,
+)
+from batch_api import BatchRunner, LocalBatchProvider
+from completion_cache import CompletionCache, CachedChatCompletionEndPoint
+from mock import MockChatCompletionEndPoint
+
+# Sampling parameters of the requests, deterministic so they are cached
+PARAMS = {"temperature": 0}
+
+
+class CountingProvider(LocalBatchProvider):
+    """
+    LocalBatchProvider that counts its submissions and returns the result
+    lines of a batch in reverse order.
+    """
+
+    def __init__(self, path, respond=None):
+        super().__init__(path, respond=respond)
+        self.submitted = 0
+
+    def submit(self, input_path) -> str:
+        self.submitted += 1
+        return super().submit(input_path)
+
+    def poll(self, batch_id):
+        status, lines = super().poll(batch_id)
+        return status, lines[::-1] if lines is not None else None
+
+
+class InterruptedProvider(LocalBatchProvider):
+    """
+    LocalBatchProvider whose polls fail, like a run stopped while waiting.
+    """
+
+    def poll(self, batch_id):
+        raise KeyboardInterrupt
+
+
+@pytest.fixture
+def mock_chatbot():
+    return MockChatCompletionEndPoint(latency=0, jitter=0)
+
+
+def hazard_request():
+    message_list = MessageList()
+    message_list.add_message(
+        DevSysUserMessage("system", TextContent("List states and conditions."))
+    )
+    message_list.add_message(DevSysUserMessage("user", TextContent("Loss:\n{loss}")))
+    return message_list
+
+
+def loss_contexts(n):
+    contexts = []
+    for i in range(n):
+        context = SubstitutionDict()
+        context["loss"] = f"Loss {i}"
+        contexts.append(context)
+    return contexts
+
+
+def response_texts(responses):
+    return [res[0][0].text for res, meta in responses]
+
+
+def test_results_in_input_order(tmp_path, mock_chatbot):
+    provider = CountingProvider(
+        os.path.join(tmp_path, "local"), respond=mock_chatbot.respond
+    )
+    runner = BatchRunner(provider, path=str(tmp_path), poll_interval=0)
+    message_list = hazard_request()
+    contexts = loss_contexts(5)
+
+    responses = runner.run(
+        "identify_hazards", mock_chatbot, message_list, contexts, PARAMS
+    )
+
+    # A fresh server answers the same requests sent one by one identically
+    direct = MockChatCompletionEndPoint(latency=0, jitter=0)
+    expected = [
+        direct.completions(message_list, substitution_dict=context, **PARAMS)
+        for context in contexts
+    ]
+    assert provider.submitted == 1
+    assert response_texts(responses) == response_texts(expected)
+
+
+def test_rerun_reuses_completion_cache(tmp_path, mock_chatbot):
+    provider = CountingProvider(
+        os.path.join(tmp_path, "local"), respond=mock_chatbot.respond
+    )
+    runner = BatchRunner(provider, path=str(tmp_path), poll_interval=0)
+    chatbot = CachedChatCompletionEndPoint(
+        mock_chatbot, CompletionCache(os.path.join(tmp_path, "completions.sqlite"))
+    )
+    message_list = hazard_request()
+
+    first = runner.run(
+        "identify_hazards", chatbot, message_list, loss_contexts(3), PARAMS
+    )
+    requests = mock_chatbot.server.requests
+    second = runner.run(
+        "identify_hazards", chatbot, message_list, loss_contexts(4), PARAMS
+    )
+
+    # Only the new request is submitted, in a batch of its own
+    assert provider.submitted == 2
+    assert mock_chatbot.server.requests == requests + 1
+    assert response_texts(second)[:3] == response_texts(first)
+
+
+def test_resume_saved_batch(tmp_path, mock_chatbot):
+    message_list = hazard_request()
+    contexts = loss_contexts(3)
+    interrupted = InterruptedProvider(os.path.join(tmp_path, "local"))
+    runner = BatchRunner(interrupted, path=str(tmp_path), poll_interval=0)
+    with pytest.raises(KeyboardInterrupt):
+        runner.run("identify_hazards", mock_chatbot, message_list, contexts, PARAMS)
+
+    provider = CountingProvider(
+        os.path.join(tmp_path, "local"), respond=mock_chatbot.respond
+    )
+    runner = BatchRunner(provider, path=str(tmp_path), poll_interval=0)
+    responses = runner.run(
+        "identify_hazards", mock_chatbot, message_list, contexts, PARAMS
+    )
+
+    assert provider.submitted == 0
+    assert len(responses) == 3
+    assert all(response is not None for response in responses)
@@ -1,4 +1,6 @@
+import os
 import sys
+import gzip
 import json
 
 
@@ -29,3 +31,116 @@ def load_from_json(path):
     with open(path, "r") as file:
         content = json.load(file)  # Read and parse the JSON file
     return content
+
+
+# Utility function to roughly estimate the number of tokens in a text
+def estimate_tokens(text):
+    # Roughly four characters per token for English text
+    return len(text) // 4 + 1
+
+
+# File suffixes of step results
+RECORD_SUFFIXES = [".jsonl.gz", ".jsonl", ".json"]
+
+
+# Utility function to open a JSONL file as text, gzip-compressed if it ends in .gz
+def open_records(path, mode="r"):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+class RecordWriter:
+    """
+    Writes records to a JSONL file one line at a time. Every line is flushed
+    as soon as it is written, so readers can follow a file that is still
+    being written, also when it is gzip-compressed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self._file = open_records(path, "w")
+
+    def write(self, record):
+        self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+        self.count += 1
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# Utility function to save records to a JSONL file, one record per line
+def save_to_jsonl(records, path):
+    with RecordWriter(path) as writer:
+        for record in records:
+            writer.write(record)
+
+
+# Utility function to read the records of a JSONL file one at a time. A file
+# that is still being written ends at its last complete line.
+def load_from_jsonl(path):
+    with open_records(path, "r") as file:
+        try:
+            for line in file:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # Ignore a partially written last line
+        except EOFError:
+            return  # Compressed stream that is still being written
+
+
+# Utility function to get the file of a step result saved as JSONL, compressed
+# JSONL or pretty-printed JSON, given its path without suffix. The newest file
+# wins when a step was saved in several formats by different runs.
+def find_records(base_path):
+    paths = [
+        base_path + suffix
+        for suffix in RECORD_SUFFIXES
+        if os.path.exists(base_path + suffix)
+    ]
+    if paths:
+        return max(paths, key=os.path.getmtime)
+    raise FileNotFoundError(f"No {base_path}{{{','.join(RECORD_SUFFIXES)}}} file found")
+
+
+# Utility function to read the records of a step result one at a time,
+# whichever format it was saved in
+def load_records(base_path):
+    path = find_records(base_path)
+    if path.endswith(".json"):
+        return iter(load_from_json(path))
+    return load_from_jsonl(path)
+
+
+# Utility function to save the records of a step result as JSONL, optionally
+# compressed, or as pretty-printed JSON. With export_json, a pretty-printed
+# JSON copy is written next to the JSONL file. Returns the path written.
+def save_records(
+    records, base_path, format="jsonl", compress=False, export_json=False
+) -> str:
+    if format == "json":
+        save_to_json(list(records), base_path + ".json")
+        return base_path + ".json"
+    if format != "jsonl":
+        raise ValueError(
+            f"Invalid output format: {format}. Must be one of ['jsonl', 'json']"
+        )
+    path = base_path + (".jsonl.gz" if compress else ".jsonl")
+    save_to_jsonl(records, path)
+    if export_json:
+        export_to_json(path, base_path + ".json")
+    return path
+
+
+# Utility function to export a JSONL file as pretty-printed JSON
+def export_to_json(path, json_path):
+    save_to_json(list(load_from_jsonl(path)), json_path)
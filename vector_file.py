@@ -0,0 +1,71 @@
+import os
+import fcntl
+from contextlib import contextmanager
+import numpy as np
+
+
+# Hold an exclusive lock on the file at path, to serialize appends with other
+# processes sharing a store
+@contextmanager
+def file_lock(path):
+    with open(path, "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+class VectorFile:
+    """
+    Append-only matrix of float32 rows in a raw file, memory-mapped for
+    reading. Only complete rows are mapped, so a torn write at the end of the
+    file is ignored until the next append drops it. The row width is set by
+    the first append unless dim is given.
+    """
+
+    def __init__(self, path, dim=None):
+        self.path = path
+        self.dim = dim
+        self.map()
+
+    def size(self) -> int:
+        try:
+            return os.path.getsize(self.path)
+        except FileNotFoundError:
+            return 0
+
+    # Memory-map the complete rows of the file
+    def map(self):
+        self.rows = 0
+        self.vectors = None
+        if self.dim is None:
+            return
+        self.rows = self.size() // (self.dim * 4)
+        if self.rows > 0:
+            self.vectors = np.memmap(
+                self.path, dtype=np.float32, mode="r", shape=(self.rows, self.dim)
+            )
+
+    # Append rows and return the row of the first. Callers serialize appends
+    # with file_lock.
+    def append(self, vectors: np.ndarray) -> int:
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        if self.dim is None:
+            self.dim = vectors.shape[1]
+        elif self.dim != vectors.shape[1]:
+            raise ValueError(
+                f"Embedding dimension {vectors.shape[1]} does not match dimension {self.dim} of {self.path}"
+            )
+        with open(self.path, "ab") as file:
+            # Drop the fragment of a torn write, so rows stay aligned
+            start = file.tell() // (self.dim * 4)
+            file.truncate(start * self.dim * 4)
+            file.write(vectors.tobytes())
+        self.map()
+        return start
+
+    # Replace the file with the given rows
+    def rewrite(self, vectors: np.ndarray):
+        with open(self.path + ".tmp", "wb") as file:
+            file.write(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+        self.vectors = None
+        os.replace(self.path + ".tmp", self.path)
+        self.map()
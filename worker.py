@@ -0,0 +1,186 @@
+import os
+import time
+import socket
+import logging
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from OpenAIChatHelper import ChatCompletionEndPoint
+from OpenAIChatHelper.message import SubstitutionDict
+from config import load_config
+from executor import parse_response
+from task_queue import TaskQueue, load_function, load_message_list
+from main import setup
+
+
+# Send the request of a task and parse its response, sending it again when
+# the response fails to parse
+def execute(chatbot: ChatCompletionEndPoint, payload: dict, step: str = None):
+    message_list = load_message_list(payload["messages"])
+    params = {"model": payload["model"], **payload["params"]}
+    response = chatbot.completions(
+        message_list, substitution_dict=SubstitutionDict(), **params
+    )
+    return parse_response(
+        chatbot,
+        message_list,
+        SubstitutionDict(),
+        response,
+        load_function(payload["parse"]),
+        step,
+        **params,
+    )
+
+
+class Worker:
+    """
+    Leases tasks from a TaskQueue and runs up to concurrency of them at once.
+    While tasks are in progress their leases are extended every third of the
+    lease time, so only the tasks of a worker that died are leased again.
+    With idle_timeout, the worker exits after that many seconds without tasks.
+    """
+
+    def __init__(
+        self,
+        queue: TaskQueue,
+        chatbot: ChatCompletionEndPoint,
+        concurrency=8,
+        worker_id=None,
+        idle_timeout=None,
+        poll_interval=1.0,
+    ):
+        self.queue = queue
+        self.chatbot = chatbot
+        self.concurrency = concurrency
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.idle_timeout = idle_timeout
+        self.poll_interval = poll_interval
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    # Run one task and report its result or error to the queue
+    def process(self, task_id, step, payload):
+        try:
+            result = execute(self.chatbot, payload, step)
+        except Exception as e:
+            logging.warning(f"Task {task_id} of {step} failed: {e!r}")
+            self.queue.fail(self.worker_id, task_id, repr(e))
+        else:
+            self.queue.ack(self.worker_id, task_id, result)
+        finally:
+            with self._lock:
+                self._in_flight.pop(task_id, None)
+
+    def _heartbeat(self):
+        while not self._stopped.wait(self.queue.lease_seconds / 3):
+            with self._lock:
+                ids = list(self._in_flight)
+            if ids:
+                self.queue.extend(self.worker_id, ids)
+
+    # Lease and run tasks until stopped, or idle for idle_timeout seconds
+    def run(self):
+        logging.info(f"Worker {self.worker_id} polling {self.queue.path}")
+        heartbeat = threading.Thread(target=self._heartbeat, daemon=True)
+        heartbeat.start()
+        idle_since = time.monotonic()
+        done = 0
+        try:
+            with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+                while not self._stopped.is_set():
+                    with self._lock:
+                        free = self.concurrency - len(self._in_flight)
+                    tasks = self.queue.lease(self.worker_id, free) if free else []
+                    for task_id, step, payload in tasks:
+                        with self._lock:
+                            self._in_flight[task_id] = step
+                        pool.submit(self.process, task_id, step, payload)
+                    done += len(tasks)
+
+                    with self._lock:
+                        busy = bool(self._in_flight)
+                    if tasks or busy:
+                        idle_since = time.monotonic()
+                    elif (
+                        self.idle_timeout is not None
+                        and time.monotonic() - idle_since >= self.idle_timeout
+                    ):
+                        break
+                    if not tasks:
+                        time.sleep(self.poll_interval)
+        finally:
+            self._stopped.set()
+        logging.info(f"Worker {self.worker_id} stopped after {done} tasks")
+
+    def stop(self):
+        self._stopped.set()
+
+
+# Give every one of the given number of workers an equal share of the
+# requests and tokens per minute of the rate_limit section
+def share_rate_limit(config, workers: int):
+    if config.get("rate_limit") is None or workers <= 1:
+        return config
+    rate_limit = dict(config["rate_limit"])
+    for name in ("requests_per_minute", "tokens_per_minute"):
+        if rate_limit.get(name) is not None:
+            rate_limit[name] = rate_limit[name] / workers
+    return {**config, "rate_limit": rate_limit}
+
+
+# Run a worker for the task queue configured in config, with the chatbot,
+# rate limits and caches it configures. The rate limits are split between
+# the workers of the queue, local_workers unless workers is set.
+def run_worker(config, concurrency=None, worker_id=None, idle_timeout=None):
+    queue_config = config["task_queue"]
+    workers = queue_config.get("workers") or queue_config.get("local_workers") or 1
+    chatbot = setup(share_rate_limit(config, workers))
+    queue = TaskQueue(
+        queue_config.get("path", ".cache/tasks.sqlite"),
+        lease_seconds=queue_config.get("lease_seconds", 300),
+        max_attempts=queue_config.get("max_attempts", 5),
+    )
+    if concurrency is None and config.get("concurrency") is not None:
+        concurrency = config["concurrency"]["max_workers"]
+    Worker(
+        queue,
+        chatbot,
+        concurrency=concurrency or 8,
+        worker_id=worker_id,
+        idle_timeout=idle_timeout,
+    ).run()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run the queued requests of analyses using a shared task queue."
+    )
+    parser.add_argument("--config", default="config.yml", help="Config file.")
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        help="Tasks run at the same time, max_workers of the config by default.",
+    )
+    parser.add_argument("--id", help="Worker id, host and process id by default.")
+    parser.add_argument(
+        "--idle-timeout",
+        type=float,
+        help="Exit after this many seconds without tasks.",
+    )
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    if config.get("task_queue") is None:
+        parser.error(f"No task_queue section in {args.config}")
+    run_worker(
+        config,
+        concurrency=args.concurrency,
+        worker_id=args.id,
+        idle_timeout=args.idle_timeout,
+    )
+
+
+# Entry point for the script
+if __name__ == "__main__":
+    main()